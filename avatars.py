@@ -0,0 +1,78 @@
+"""
+Member avatars, served from our own domain.
+
+People's pages show an avatar for every member. Rather than have each
+browser fetch them all from Gravatar, /avatar/<hash> fetches each size
+once per instance, keeps it in an AvatarCache, and serves it with an ETag
+and long cache headers. Only the hashes of people we have are fetched.
+The fetcher is set with app.config['AVATAR_FETCHER'], so tests and load
+runs can swap in their own.
+"""
+
+import collections
+import hashlib
+import threading
+
+# The sizes we serve; a request is rounded up to the next one
+AVATAR_SIZES = [20, 40, 80, 160]
+
+def emailHash(email):
+    """ Gravatar's key for an email address """
+    return hashlib.md5(email.strip().lower().encode("utf-8")).hexdigest()
+
+def gravatarUrl(avatarHash, size):
+    return "https://www.gravatar.com/avatar/{}?s={}&d=retro".format(avatarHash, size)
+
+def servedSize(size):
+    for served in AVATAR_SIZES:
+        if size <= served:
+            return served
+    return AVATAR_SIZES[-1]
+
+class GravatarFetcher(object):
+    """ Fetches avatars from Gravatar, already at the size asked for """
+    def fetch(self, avatarHash, size):
+        from google.appengine.api import urlfetch
+        result = urlfetch.fetch(gravatarUrl(avatarHash, size), deadline=5)
+        if result.status_code != 200:
+            raise Exception("Gravatar answered {}".format(result.status_code))
+        return result.content, result.headers.get("Content-Type", "image/jpeg")
+
+class Avatar(object):
+    def __init__(self, body, contentType):
+        self.body = body
+        self.contentType = contentType
+        self.etag = hashlib.md5(body).hexdigest()
+
+class AvatarCache(object):
+    """ The most recently served avatars, up to maxEntries of them """
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, avatarHash, size, fetcher, isKnown=None):
+        """ The avatar, from the cache or fetched. On a miss, isKnown is
+        asked first; a hash it doesn't know gets None, and isn't fetched or
+        kept, so made-up hashes can't push real avatars out. """
+        key = (avatarHash, size)
+        with self.lock:
+            avatar = self.entries.pop(key, None)
+            if avatar is not None:
+                self.hits += 1
+                self.entries[key] = avatar
+                return avatar
+            self.misses += 1
+
+        if isKnown is not None and not isKnown(avatarHash):
+            return None
+        # Fetched outside the lock; two requests for the same new avatar
+        # may both fetch it, which is cheaper than making everyone wait
+        avatar = Avatar(*fetcher.fetch(avatarHash, size))
+        with self.lock:
+            self.entries[key] = avatar
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return avatar
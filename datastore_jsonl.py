@@ -0,0 +1,106 @@
+"""
+Entities as JSON lines, for copying SantaBot's data in and out in bulk.
+
+Each line is one entity:
+
+    {"kind": "SantaGroup", "key": ["SantaGroup", 5629499534213120], "values": {...}}
+
+Keys are written as their flat paths rather than urlsafe strings, so a
+production export loads into a dev server under a different app id.
+Blobs are base64; dates are ISO 8601.
+"""
+
+import base64
+import datetime
+import json
+
+from google.appengine.ext import ndb
+
+DATE_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]
+
+def _dumpValue(prop, value):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return list(value.flat())
+    if isinstance(prop, ndb.DateTimeProperty):
+        return value.isoformat()
+    # Text and JSON are blobs to ndb too, but they're JSON already
+    if isinstance(prop, (ndb.TextProperty, ndb.JsonProperty)):
+        return value
+    if isinstance(prop, ndb.BlobProperty):
+        return base64.b64encode(value)
+    return value
+
+def _loadValue(prop, value):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    if isinstance(prop, ndb.DateTimeProperty):
+        for dateFormat in DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, dateFormat)
+            except ValueError:
+                pass
+        raise ValueError("Bad date {}".format(value))
+    if isinstance(prop, (ndb.TextProperty, ndb.JsonProperty)):
+        return value
+    if isinstance(prop, ndb.BlobProperty):
+        return base64.b64decode(value)
+    return value
+
+def dumpEntity(entity):
+    """ One entity as a line of JSON, newline included """
+    values = {}
+    for name, prop in entity._properties.items():
+        value = prop._get_value(entity)
+        if prop._repeated:
+            values[name] = [_dumpValue(prop, v) for v in value]
+        else:
+            values[name] = _dumpValue(prop, value)
+    return json.dumps({"kind": entity._get_kind(), "key": list(entity.key.flat()), "values": values}) + "\n"
+
+def loadEntity(line, models):
+    """ The entity on one line of JSON. models maps the kinds that may be
+    loaded to their classes; anything else raises KeyError. """
+    record = json.loads(line)
+    model = models[record["kind"]]
+    values = {}
+    for name, value in record["values"].items():
+        prop = model._properties.get(name)
+        if prop is None:
+            # Dropped from the model since the export
+            continue
+        if prop._repeated:
+            values[name] = [_loadValue(prop, v) for v in value or []]
+        else:
+            values[name] = _loadValue(prop, value)
+    entity = model(key=ndb.Key(flat=record["key"]))
+    entity.populate(**values)
+    return entity
+
+def dumpPage(model, pageSize, cursor=None):
+    """ One page of model's entities as JSON lines, with the cursor for the
+    next page and whether there is one. The context cache is skipped;
+    nothing here is read twice. """
+    entities, nextCursor, more = model.query().fetch_page(pageSize, start_cursor=cursor, use_cache=False)
+    return [dumpEntity(entity) for entity in entities], nextCursor, more
+
+def loadLines(lines, models, batchSize):
+    """ Stores the entities in lines, batchSize at a time. Returns how many
+    of each kind were stored. """
+    counts = dict((kind, 0) for kind in models)
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        entity = loadEntity(line, models)
+        batch.append(entity)
+        counts[entity._get_kind()] += 1
+        if len(batch) >= batchSize:
+            ndb.put_multi(batch, use_cache=False)
+            batch = []
+    if batch:
+        ndb.put_multi(batch, use_cache=False)
+    return counts
@@ -0,0 +1,204 @@
+"""
+Load-tests SantaBot on one machine, no deployment needed.
+
+The app runs through Flask's test client on top of the App Engine SDK's
+testbed: the real ndb, users, mail, memcache and task queue APIs, backed
+by in-memory stubs. Queued tasks are run as their own requests, the way
+App Engine would.
+
+    pip install -r requirements.txt -t lib/
+    python loadtest.py --sdk ~/google-cloud-sdk/platform/google_appengine --groups 20 --members 30
+
+Every group is created, joined by its members, closed, has every list
+submitted (which runs it), gets a daily cron sweep partway through, and
+has its results viewed. For each endpoint it reports the requests made,
+how many failed, the requests per second it could serve one at a time,
+latency percentiles and datastore operations per request.
+"""
+
+import argparse, collections, math, os, random, sys, time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def setUpPaths(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    import appengine_config
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+class LoadTest(object):
+    def __init__(self, members, seed):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # Every write is visible to the next query, so runs are repeatable
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.mail = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+
+        import main
+        import request_metrics
+        self.main = main
+        self.client = main.app.test_client()
+        request_metrics.addListener(self.record)
+
+        self.members = members
+        self.random = random.Random(seed)
+        self.requestNumber = 0
+        self.results = collections.defaultdict(list)
+
+    def record(self, summary):
+        self.results[summary["endpoint"]].append(summary)
+
+    def actAs(self, userNumber, admin=False):
+        self.testbed.setup_env(overwrite=True, USER_EMAIL="santa{}@example.com".format(userNumber),
+            USER_ID=str(100000 + userNumber), USER_IS_ADMIN="1" if admin else "0")
+
+    def request(self, method, path, **kwargs):
+        # Mail goes out from worker threads; a request id in the environment
+        # lets request_metrics count it against the request
+        self.requestNumber = self.requestNumber + 1
+        os.environ["REQUEST_LOG_ID"] = "loadtest-{}".format(self.requestNumber)
+        return getattr(self.client, method)(path, **kwargs)
+
+    def runTasks(self):
+        """ Runs queued tasks, and the tasks they queue, until none are left """
+        self.actAs(0, admin=True)
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks()
+            if not tasks:
+                return
+            for task in tasks:
+                self.taskqueue.DeleteTask(task.queue_name, task.name)
+                self.request("post", task.url, data=task.payload,
+                    content_type="application/x-www-form-urlencoded")
+
+    def signUp(self, userNumber):
+        self.actAs(userNumber)
+        self.request("get", "/")
+        self.request("post", "/profile/update", data={"userName": "Santa {}".format(userNumber), "destination": ""})
+
+    def personKey(self, userNumber):
+        return self.main.SantaPerson.keyFor(str(100000 + userNumber)).urlsafe()
+
+    def run(self, groups):
+        started = time.time()
+        plans = []
+        nextUser = 1
+        for g in range(groups):
+            people = list(range(nextUser, nextUser + self.members))
+            nextUser = nextUser + self.members
+            plans.append({"name": "Load test group {}".format(g), "owner": people[0], "people": people})
+
+        # Owners create their groups
+        for plan in plans:
+            self.signUp(plan["owner"])
+            response = self.request("post", "/group/new", data={"groupName": plan["name"]})
+            plan["id"] = response.headers["Location"].rstrip("/").split("/")[-1]
+        self.runTasks()
+
+        # Everyone else joins, in no particular order, and looks around
+        joins = [(plan, person) for plan in plans for person in plan["people"][1:]]
+        self.random.shuffle(joins)
+        for plan, person in joins:
+            self.signUp(person)
+            self.request("get", "/group/{}/join".format(plan["id"]))
+            self.request("get", "/group/{}".format(plan["id"]))
+            self.request("get", "/")
+        self.runTasks()
+
+        for plan in plans:
+            self.actAs(plan["owner"])
+            self.request("get", "/group/{}/close".format(plan["id"]))
+            self.request("get", "/group/{}".format(plan["id"]))
+        self.runTasks()
+
+        # Lists come in; halfway through, the daily sweep reminds the rest
+        submissions = [(plan, person) for plan in plans for person in plan["people"]]
+        self.random.shuffle(submissions)
+        for i, (plan, person) in enumerate(submissions):
+            if i == len(submissions) // 2:
+                self.actAs(0, admin=True)
+                self.request("get", "/admin/cron/daily")
+                self.runTasks()
+
+            others = [p for p in plan["people"] if p != person]
+            noList = self.random.sample(others, self.random.randint(0, min(2, len(others) - 2)))
+            form = {"message": "Anything with a dinosaur on it, or socks. Lots of socks."}
+            for n, avoid in enumerate(noList):
+                form["unchecked{}".format(n)] = self.personKey(avoid)
+
+            self.actAs(person)
+            self.request("get", "/group/{}".format(plan["id"]))
+            self.request("post", "/group/{}/ready".format(plan["id"]), data=form)
+            self.runTasks()
+
+        # Everyone reads their result, owners check on their group
+        for plan in plans:
+            for person in plan["people"]:
+                self.actAs(person)
+                self.request("get", "/group/{}".format(plan["id"]))
+            self.actAs(0, admin=True)
+            self.request("get", "/admin/group/{}".format(plan["id"]))
+        self.request("get", "/admin")
+
+        return time.time() - started
+
+    def report(self, elapsed):
+        total = sum(len(r) for r in self.results.values())
+        print("{} requests in {:.1f}s, {:.0f}/s; {} emails sent".format(
+            total, elapsed, total / elapsed, len(self.mail.get_sent_messages())))
+        print("")
+        print("{:<28} {:>7} {:>6} {:>7} {:>8} {:>8} {:>8} {:>6} {:>6} {:>6} {:>6}".format(
+            "endpoint", "count", "fail", "req/s", "p50 ms", "p90 ms", "p99 ms", "get", "query", "put", "rpcs"))
+
+        for endpoint, summaries in sorted(self.results.items(), key=lambda item: -sum(s["ms"] for s in item[1])):
+            latencies = [s["ms"] for s in summaries]
+            failed = len([s for s in summaries if s["status"] is None or s["status"] >= 500])
+            rpcs = collections.Counter()
+            for s in summaries:
+                rpcs.update(s["rpcs"])
+            per = lambda name: float(rpcs[name]) / len(summaries)
+            print("{:<28} {:>7} {:>6} {:>7.0f} {:>8.1f} {:>8.1f} {:>8.1f} {:>6.1f} {:>6.1f} {:>6.1f} {:>6.1f}".format(
+                endpoint, len(summaries), failed, len(summaries) / (sum(latencies) / 1000.0),
+                percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+                per("get"), per("query") + per("query_next"), per("put"), sum(rpcs.values()) / float(len(summaries))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive SantaBot with scripted traffic against in-memory App Engine stubs")
+    parser.add_argument("--sdk", default=os.environ.get("APPENGINE_SDK"),
+        help="the App Engine Python SDK directory, or set APPENGINE_SDK")
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--members", type=int, default=20, help="people per group, owner included; at least 3")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if not args.sdk:
+        parser.error("need --sdk or APPENGINE_SDK")
+    if args.members < 3:
+        parser.error("groups need at least 3 members to close")
+    setUpPaths(args.sdk)
+
+    import logging
+    # request_metrics logs every request; the report covers it
+    logging.getLogger().setLevel(logging.WARNING)
+
+    test = LoadTest(args.members, args.seed)
+    test.report(test.run(args.groups))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Renders SantaBot's emails in batches.
+
+Every message in a fan-out shares the group's name and page link; only the
+names and shopping advice change per recipient. EmailRenderer looks the
+email templates up once per process and renders a whole list of
+recipients against one shared group context.
+"""
+
+# Each kind of email has a plain text and an HTML template
+EMAIL_TEMPLATES = {
+    "welcome": ("email-welcome.txt", "email-welcome.html"),
+    "complete": ("email-complete.txt", "email-complete.html"),
+    "result": ("email-result.txt", "email-result.html"),
+}
+
+class EmailRenderer(object):
+    def __init__(self, jinjaEnv):
+        self.templates = {}
+        for kind, (txtName, htmlName) in EMAIL_TEMPLATES.items():
+            self.templates[kind] = (jinjaEnv.get_template(txtName), jinjaEnv.get_template(htmlName))
+
+    def renderBatch(self, kind, groupContext, recipients):
+        """ Renders kind for each recipient's context on top of the shared
+        group context. Returns a (body, html) tuple per recipient. """
+        txt, html = self.templates[kind]
+        rendered = []
+        for recipient in recipients:
+            context = dict(groupContext)
+            context.update(recipient)
+            rendered.append((txt.render(context), html.render(context)))
+        return rendered
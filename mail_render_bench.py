@@ -0,0 +1,70 @@
+"""
+Measures what it costs to render the result email for a big run.
+
+Needs only Jinja2:
+
+    python mail_render_bench.py --recipients 1000
+
+"uncached" compiles both templates for every message, "lookup" fetches
+them from a caching environment per message (what render_template does,
+including Jinja's up-to-date check on the file), and "batch" is
+EmailRenderer rendering the whole run against one group context.
+"""
+
+import argparse, os, time
+
+from jinja2 import Environment, FileSystemLoader
+
+from mail_render import EmailRenderer, EMAIL_TEMPLATES
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+def environment(cacheSize=400):
+    # Flask escapes .html templates and leaves .txt alone
+    return Environment(loader=FileSystemLoader(TEMPLATE_DIR), cache_size=cacheSize,
+        autoescape=lambda name: name is not None and name.endswith(".html"))
+
+def recipients(count):
+    advice = "I have been very good this year. Socks, books about trains, and anything with a dinosaur on it."
+    return [{"sourceName": "Santa %d" % i, "targetName": "Giftee %d" % i, "shoppingAdvice": advice}
+            for i in range(count)]
+
+def groupContext():
+    return {"groupName": "2026 Sales Party", "groupPage": "https://santabot.co/group/ahFzfnNlY3JldHNhbnRhYm90d2lu"}
+
+def perMessage(env, people):
+    txtName, htmlName = EMAIL_TEMPLATES["result"]
+    for person in people:
+        context = dict(groupContext())
+        context.update(person)
+        env.get_template(txtName).render(context)
+        env.get_template(htmlName).render(context)
+
+def batch(env, people):
+    EmailRenderer(env).renderBatch("result", groupContext(), people)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark email rendering for one group run")
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5, help="best of this many runs is reported")
+    args = parser.parse_args()
+
+    people = recipients(args.recipients)
+    cases = [
+        ("uncached", lambda: perMessage(environment(cacheSize=0), people)),
+        ("lookup", lambda: perMessage(environment(), people)),
+        ("batch", lambda: batch(environment(), people)),
+    ]
+
+    print("{:<10} {:>12} {:>14}".format("mode", "total ms", "per message us"))
+    for name, case in cases:
+        best = None
+        for i in range(args.repeat):
+            start = time.time()
+            case()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{:<10} {:>12.1f} {:>14.1f}".format(name, best * 1000.0, best * 1e6 / args.recipients))
+
+if __name__ == "__main__":
+    main()
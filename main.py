@@ -17,50 +17,148 @@
 """
 
 # Import the Flask Framework
+import flask
 from flask import Flask
-from flask import render_template, redirect, url_for, request, abort, flash
+from flask import redirect, url_for, request, abort, flash, jsonify, g, Response
 app = Flask(__name__)
 app.secret_key = 'squirrel'
+# Run task queue work in-process instead, for local testing
+app.config['RUN_TASKS_INLINE'] = False
+# Messages per mail task; the mail queue decides how many run at once
+app.config['MAIL_BATCH_SIZE'] = 10
+# Log the RPCs of any request slower than this many ms; None turns it off
+app.config['SLOW_REQUEST_MS'] = 1000
 
 import logging
-import random
 import string
 import datetime
-import urllib, hashlib
+import importlib
+import uuid
 
 # Google APIs
 from google.appengine.api import users
 from google.appengine.ext import ndb
-from google.appengine.api import mail
-
-# Santa help
-from people_matcher import PeopleMatcher
+from google.appengine.api import taskqueue
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+
+# Santa help. The matcher, outbox and bulk data modules are imported where
+# they're used, so a new instance doesn't load them before its first page.
+from mail_render import EmailRenderer
+import request_metrics
+import avatars
+import jinja2
+
+request_metrics.install(app)
+
+# Where queued mail goes: None is App Engine's mail API, or use
+# outbox.SmtpTransport() for a local sink
+app.config['MAIL_TRANSPORT'] = None
+
+# Where avatars come from: None is Gravatar, or any object with a
+# fetch(avatarHash, size) returning (body, contentType)
+app.config['AVATAR_FETCHER'] = None
+# Avatars each instance keeps in memory
+app.config['AVATAR_CACHE_SIZE'] = 1000
+
+# Compiled templates are shared through memcache, so a new instance doesn't
+# compile them all again. Entries are keyed by template name; each holds a
+# checksum of the source it was compiled from, and is compiled again when
+# a deploy changes the template.
+app.jinja_options = dict(app.jinja_options,
+    bytecode_cache=jinja2.MemcachedBytecodeCache(memcache, prefix="jinja2/bytecode/"))
 
 # Constants
 SANTABOT_SEND_FROM = "The Santabot Elfbots <elfbots@secretsantabotwin.appspotmail.com>"
 
+# SantaGroup.runStatus values. A run goes pending -> solving -> emailing ->
+# done, or stops at incomplete or failed.
+RUN_PENDING = "pending"
+RUN_SOLVING = "solving"
+RUN_EMAILING = "emailing"
+RUN_INCOMPLETE = "incomplete"
+RUN_FAILED = "failed"
+RUN_DONE = "done"
+RUN_IN_PROGRESS = (RUN_PENDING, RUN_SOLVING, RUN_EMAILING)
+
+# How long a run task holds a group. Longer than a task may run, so a
+# lease only runs out once its holder is dead.
+RUN_LEASE = datetime.timedelta(minutes=15)
+
+# Groups per page of the daily reminder sweep
+SWEEP_PAGE_SIZE = 50
+# A sweep that hasn't moved on in this long has lost its task
+SWEEP_STALL = datetime.timedelta(minutes=30)
+
+# Groups per page of /admin, and the orders it can list them in
+ADMIN_PAGE_SIZE = 25
+ADMIN_SORTS = {
+    "created": lambda: -SantaGroup.createDate,
+    "name": lambda: SantaGroup.name,
+    "run": lambda: -SantaGroup.runDate,
+}
+
+# People moved or backfilled per migration task
+MIGRATION_PAGE_SIZE = 20
+# How long migrate_people_task waits for queries to catch up with its
+# changes before it looks for references to old people again
+MIGRATION_RECHECK_SECONDS = 60
+
+# Entities per request to /admin/export, and per put of /admin/import.
+# Each is one request, well inside the deadline and response size limit.
+EXPORT_PAGE_SIZE = 500
+IMPORT_BATCH_SIZE = 200
+# Lines one request to /admin/import may carry
+IMPORT_REQUEST_LINES = 1000
+
 #
 # Data models
 #
 class SantaPerson(ndb.Model):
-    """ Describes a partipciant in the Secret Santa """
+    """ Describes a partipciant in the Secret Santa. Keyed by user id, see
+    keyFor; older records live under peopleKey until they're migrated. """
     email = ndb.StringProperty()
     name = ndb.StringProperty()
     createDate = ndb.DateTimeProperty(auto_now_add=True)
     userId = ndb.StringProperty()
+    # Hash of the email, for Gravatar; kept up to date on every put.
+    # Indexed so /avatar only serves people we have.
+    avatarHash = ndb.StringProperty()
+
+    @classmethod
+    def keyFor(cls, userId):
+        return ndb.Key(cls, userId)
+
+    def _pre_put_hook(this):
+        if this.email:
+            this.avatarHash = avatars.emailHash(this.email)
 
     def getAvatarUrl(this, size=80):
-        email = this.email.lower()
-        return "https://www.gravatar.com/avatar/" + hashlib.md5(email).hexdigest() + "?s=" + str(size) + "&d=retro"
+        # People who haven't been saved since the hash was kept get theirs
+        # straight from Gravatar
+        if not this.avatarHash:
+            return avatars.gravatarUrl(avatars.emailHash(this.email), size)
+        return "/avatar/{}?s={}".format(this.avatarHash, avatars.servedSize(size))
 
 
 class SantaPairing(ndb.Model):
-    """ Represents a pair of partipciants in a Secret Santa run. """    
+    """ Represents a pair of partipciants in a Secret Santa run. Keyed by
+    the source person under the group, see keyFor. """
     source = ndb.KeyProperty(kind="SantaRegistration")
     target = ndb.KeyProperty(kind="SantaRegistration")
+    # Copied from the target, so the result page is a single get
+    targetPerson = ndb.KeyProperty(kind=SantaPerson)
+    targetName = ndb.StringProperty(indexed=False)
+    targetAdvice = ndb.BlobProperty()
+
+    @classmethod
+    def keyFor(cls, groupKey, sourcePersonKey):
+        return ndb.Key(cls, sourcePersonKey.id(), parent=groupKey)
 
 class SantaGroup(ndb.Model):
-    """ Models a group of secret santa participants """
+    """ Models a group of secret santa participants. Its own entity group:
+    registrations, pairings and counts live under it. Older groups live
+    under groupsKey until they're migrated. """
     name = ndb.StringProperty()
     ownerId = ndb.StringProperty()
     owner = ndb.KeyProperty(kind=SantaPerson)
@@ -69,19 +167,135 @@ class SantaGroup(ndb.Model):
     runDate = ndb.DateTimeProperty()
     pairs = ndb.KeyProperty(kind=SantaPairing, repeated=True)
     advice = ndb.StringProperty()
+    runStatus = ndb.StringProperty()
+    # Which run task is working on the group, and until when
+    runLeaseOwner = ndb.StringProperty(indexed=False)
+    runLeaseUntil = ndb.DateTimeProperty(indexed=False)
+    # Set while migrate_group copies the group; nothing may change it
+    migrating = ndb.BooleanProperty(indexed=False)
 
 class SantaRegistration(ndb.Model):
-    """ Mapping, registering a Person for a Group """
+    """ Mapping, registering a Person for a Group. Keyed by the person's
+    user id under the group, see keyFor. """
     person = ndb.KeyProperty(kind=SantaPerson)
     group = ndb.KeyProperty(kind=SantaGroup)
     createDate = ndb.DateTimeProperty(auto_now_add=True)
     completionDate = ndb.DateTimeProperty()
     viewedDate = ndb.DateTimeProperty()
     prohibitedPeople = ndb.KeyProperty(kind=SantaPerson, repeated=True)
+    # Only set on registrations from before SantaWishList; see getShoppingAdvice
     shoppingAdvice = ndb.BlobProperty()
 
+    @classmethod
+    def keyFor(cls, groupKey, userId):
+        return ndb.Key(cls, userId, parent=groupKey)
+
+class SantaWishList(ndb.Model):
+    """ A member's shopping advice. Stored under their registration rather
+    than on it, so listing a group's registrations doesn't load everyone's
+    wish list. """
+    advice = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def keyFor(cls, regKey):
+        return ndb.Key(cls, "list", parent=regKey)
+
+class SantaGroupMove(ndb.Model):
+    """ Where a migrated group went, keyed by its old urlsafe key, so links
+    in old emails still work """
+    group = ndb.KeyProperty(kind=SantaGroup)
+
+class SantaGroupCounts(ndb.Model):
+    """ How many members a group has and how many have written their lists.
+    Only changed in the same transaction as the registration, and kept
+    apart from the group so other group writes can't clobber it. """
+    members = ndb.IntegerProperty(default=0, indexed=False)
+    completed = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def keyFor(cls, groupKey):
+        return ndb.Key(cls, "counts", parent=groupKey)
+
+class SantaGroupMatching(ndb.Model):
+    """ An assignment that honors every no-list submitted so far, kept up
+    to date in the same transactions as SantaGroupCounts. People are their
+    urlsafe person keys in the state. """
+    state = ndb.JsonProperty(compressed=True)
+    feasible = ndb.BooleanProperty(default=True, indexed=False)
+    # When it isn't feasible: who can only give to whom
+    blockedSources = ndb.KeyProperty(kind=SantaPerson, repeated=True, indexed=False)
+    blockedTargets = ndb.KeyProperty(kind=SantaPerson, repeated=True, indexed=False)
+
+    @classmethod
+    def keyFor(cls, groupKey):
+        return ndb.Key(cls, "matching", parent=groupKey)
+
+    def matcher(this):
+        from people_matcher import IncrementalMatcher
+        return IncrementalMatcher(this.state)
+
+    def update(this, matcher):
+        this.state = matcher.state()
+        this.feasible = matcher.feasible
+        violation = matcher.hallViolation or {"sources": [], "targets": []}
+        this.blockedSources = [ndb.Key(urlsafe=k) for k in violation["sources"]]
+        this.blockedTargets = [ndb.Key(urlsafe=k) for k in violation["targets"]]
+
+    def warmStart(this):
+        """ The assignment in the person keys group_run uses """
+        assignment = this.matcher().assignment()
+        if assignment is None:
+            return None
+        return dict((ndb.Key(urlsafe=s), ndb.Key(urlsafe=t)) for s, t in assignment.items())
+
+class GroupSummary(ndb.Model):
+    """ What the home page shows about one of a person's groups """
+    group = ndb.KeyProperty(kind=SantaGroup)
+    name = ndb.StringProperty()
+    createDate = ndb.DateTimeProperty()
+    registering = ndb.BooleanProperty()
+    runDate = ndb.DateTimeProperty()
+    completed = ndb.BooleanProperty(default=False)
+
+class SantaMemberships(ndb.Model):
+    """ A person's groups, kept up to date so the home page is a single get.
+    Keyed by user id. """
+    groups = ndb.LocalStructuredProperty(GroupSummary, repeated=True)
+
+    @classmethod
+    def keyFor(cls, userId):
+        return ndb.Key(cls, userId)
+
+    def setGroup(this, group, completed=None):
+        for summary in this.groups:
+            if summary.group == group.key:
+                break
+        else:
+            summary = GroupSummary(group=group.key)
+            this.groups.append(summary)
+
+        summary.name = group.name
+        summary.createDate = group.createDate
+        summary.registering = group.registering
+        summary.runDate = group.runDate
+        if completed is not None:
+            summary.completed = completed
+
+class DailySweep(ndb.Model):
+    """ Progress of one day's reminder sweep, keyed by date, so a sweep
+    that times out picks up where it stopped """
+    cursor = ndb.StringProperty(indexed=False)
+    pages = ndb.IntegerProperty(default=0, indexed=False)
+    groups = ndb.IntegerProperty(default=0, indexed=False)
+    startDate = ndb.DateTimeProperty(auto_now_add=True)
+    updateDate = ndb.DateTimeProperty(auto_now=True, indexed=False)
+    doneDate = ndb.DateTimeProperty()
+    # Times the sweep was queued again after it stalled
+    nudges = ndb.IntegerProperty(default=0, indexed=False)
+
 #
-# Top level (ancestor) keys for the datastore
+# Top level (ancestor) keys for the datastore. Everything used to live under
+# one of these; only records that haven't been migrated still do.
 #
 peopleKey = ndb.Key("People", "people")
 groupsKey = ndb.Key("Groups", "groups")
@@ -90,26 +304,72 @@ registrationKey = ndb.Key("Registrations", "registrations")
 #
 # Convenience Methods
 #
+def render_template(template, **context):
+    """ flask.render_template, timed for /admin/metrics """
+    with request_metrics.timed("render"):
+        return flask.render_template(template, **context)
+
 def getSantaPersonForEmail(email=None):
-    return SantaPerson.query(SantaPerson.email == email, ancestor=peopleKey).get()
+    return SantaPerson.query(SantaPerson.email == email).get()
+
+def isLegacyGroup(groupKey):
+    # Not migrated yet, see migrate_groups_task
+    return groupKey.parent() == groupsKey
+
+def registrationsQuery(groupKey, *filters):
+    """ A group's registrations, wherever the group keeps them """
+    if isLegacyGroup(groupKey):
+        return SantaRegistration.query(SantaRegistration.group == groupKey, *filters, ancestor=registrationKey)
+    return SantaRegistration.query(*filters, ancestor=groupKey)
+
+def getRegistration(groupKey, person):
+    if isLegacyGroup(groupKey):
+        return registrationsQuery(groupKey, SantaRegistration.person == person.key).get()
+    return SantaRegistration.keyFor(groupKey, person.userId).get()
+
+def newRegistration(groupKey, person):
+    if isLegacyGroup(groupKey):
+        return SantaRegistration(parent=registrationKey, group=groupKey, person=person.key)
+    return SantaRegistration(key=SantaRegistration.keyFor(groupKey, person.userId), group=groupKey, person=person.key)
+
+def getShoppingAdvice(regs):
+    """ The registrations' shopping advice in one batch, by registration key """
+    wishLists = ndb.get_multi([SantaWishList.keyFor(reg.key) for reg in regs])
+    return dict((reg.key, wishList.advice if wishList else reg.shoppingAdvice) for reg, wishList in zip(regs, wishLists))
+
+def getMovedGroupId(groupId):
+    """ The new id of a group that was migrated, or None """
+    move = SantaGroupMove.get_by_id(groupId)
+    return move.group.urlsafe() if move else None
+
+def getEntityMap(keys):
+    """ Fetches the entities for a list of keys in one batch, as a dict keyed by key """
+    keys = list(set(k for k in keys if k))
+    return dict(zip(keys, ndb.get_multi(keys)))
 
 class Unregistered(Exception):
     pass
 
 def getCurrentUserRecord():
-    record = None
-    user = users.get_current_user()
+    # Looked up at most once per request
+    if not hasattr(g, 'currentUserRecord'):
+        record = None
+        user = users.get_current_user()
+        if user and user.user_id():
+            record = getUserRecord(user.user_id()) or Unregistered
+        g.currentUserRecord = record
 
     # Return the record, or none. In which case the caller should catch it.
-    if user and user.user_id():
-        record = SantaPerson.query(SantaPerson.userId == user.user_id(), ancestor=peopleKey).get()
-        if not record:
-            raise Unregistered()
-
-    return record
+    if g.currentUserRecord is Unregistered:
+        raise Unregistered()
+    return g.currentUserRecord
 
 def getUserRecord(userid):
-    return SantaPerson.query(SantaPerson.userId == userid, ancestor=peopleKey).get()
+    record = SantaPerson.keyFor(userid).get()
+    if record is None:
+        # Not migrated yet, see migrate_people_task
+        record = SantaPerson.query(SantaPerson.userId == userid, ancestor=peopleKey).get()
+    return record
 
 def createUserProfile(destination):
     user = users.get_current_user()
@@ -120,28 +380,168 @@ def createUserProfile(destination):
     if user.nickname():
         name = user.nickname()
 
-    record = SantaPerson(parent=peopleKey, userId=user.user_id(), email=user.email(), name=name)
+    record = SantaPerson(key=SantaPerson.keyFor(user.user_id()), userId=user.user_id(), email=user.email(), name=name)
     record.put()
+    g.currentUserRecord = record
     # TODO: Redirect them to the profile page somehow
     return redirect(url_for('configure_profile', destination=destination))
 
 
-def send_mail_close_registration(userObj=None, groupObj=None):
-    message = mail.EmailMessage(sender=SANTABOT_SEND_FROM)
-    message.subject = "Complete Santa Registration for {groupName}".format(name=userObj.name, groupName=groupObj.name)
-    message.to = "{name} <{email}>".format(name=userObj.name, email=userObj.email)
-    message.body = render_template('email-complete.txt', name=userObj.name, groupName=groupObj.name, groupPage=url_for('view_group', groupId=groupObj.key.urlsafe(), _external=True))
-    message.html = render_template('email-complete.html', name=userObj.name, groupName=groupObj.name, groupPage=url_for('view_group', groupId=groupObj.key.urlsafe(), _external=True))
-    message.send()
+@ndb.transactional_tasklet
+def _updateMembership(key, group, completed):
+    memberships = yield key.get_async()
+    if memberships is None:
+        memberships = SantaMemberships(key=key)
+    memberships.setGroup(group, completed)
+    yield memberships.put_async()
+
+def update_memberships(people, group, completed=None):
+    """ Refreshes group in each person's home page summary, all at once """
+    futures = [_updateMembership(SantaMemberships.keyFor(person.userId), group, completed) for person in people]
+    for future in futures:
+        future.get_result()
+
+def build_memberships(person):
+    """ Builds a person's summary from scratch out of their registrations """
+    regs = SantaRegistration.query(SantaRegistration.person == person.key).fetch()
+    memberships = SantaMemberships(key=SantaMemberships.keyFor(person.userId))
+    for reg, group in zip(regs, ndb.get_multi([reg.group for reg in regs])):
+        if group:
+            memberships.setGroup(group, completed=reg.completionDate is not None)
+    memberships.put()
+    return memberships
+
+def enqueueTask(endpoint, queueName="default", transactional=False, name=None, countdown=None, **params):
+    """ Posts params to a task endpoint through the push queue, or right away
+    in-process when RUN_TASKS_INLINE is set. A named task is only ever
+    queued once. """
+    if app.config['RUN_TASKS_INLINE']:
+        def runTask():
+            app.test_client().post(url_for(endpoint), data=params)
+        # Like a transactional task, only once the transaction commits
+        ndb.get_context().call_on_commit(runTask)
+        return
 
-def send_mail_result(sourceUser=None, targetUser=None, groupObj=None, targetReg=None):
-    message = mail.EmailMessage(sender=SANTABOT_SEND_FROM)
-    message.subject = "Secret Santa Result for {sourceName}".format(sourceName=sourceUser.name)
-    message.to = "{sourceName} <{sourceEmail}>".format(sourceName=sourceUser.name, sourceEmail=sourceUser.email)
-    message.body = render_template('email-result.txt', targetName=targetUser.name, sourceName=sourceUser.name, shoppingAdvice=targetReg.shoppingAdvice, groupName=groupObj.name, groupPage=url_for('view_group', groupId=groupObj.key.urlsafe(), _external=True))
-    message.html = render_template('email-result.html', targetName=targetUser.name, sourceName=sourceUser.name, shoppingAdvice=targetReg.shoppingAdvice, groupName=groupObj.name, groupPage=url_for('view_group', groupId=groupObj.key.urlsafe(), _external=True))
-    message.send()
+    try:
+        taskqueue.add(url=url_for(endpoint), params=params, queue_name=queueName, transactional=transactional,
+            name=name, countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info("Task {} was already queued".format(name))
+
+_emailRenderer = None
+_avatarCache = None
+
+def emailRenderer():
+    """ The email templates, looked up once per process """
+    global _emailRenderer
+    if _emailRenderer is None:
+        _emailRenderer = EmailRenderer(app.jinja_env)
+    return _emailRenderer
+
+def groupMailContext(groupObj):
+    """ The parts of a group's emails that are the same for every member """
+    return {"groupName": groupObj.name, "groupPage": url_for('view_group', groupId=groupObj.key.urlsafe(), _external=True)}
+
+def renderMails(kind, groupObj, recipients):
+    with request_metrics.timed("render"):
+        return emailRenderer().renderBatch(kind, groupMailContext(groupObj), recipients)
+
+def mail_close_registration(people=None, groupObj=None):
+    import outbox
+    rendered = renderMails("complete", groupObj, [{"name": p.name} for p in people])
+    subject = "Complete Santa Registration for {groupName}".format(groupName=groupObj.name)
+    return [outbox.OutboundMail(sender=SANTABOT_SEND_FROM, subject=subject, body=body, html=html,
+                to="{name} <{email}>".format(name=p.name, email=p.email))
+            for p, (body, html) in zip(people, rendered)]
+
+def mail_result(pairs=None, groupObj=None):
+    """ pairs is a list of (sourceUser, targetUser, shoppingAdvice) """
+    import outbox
+    rendered = renderMails("result", groupObj,
+        [{"sourceName": sourceUser.name, "targetName": targetUser.name, "shoppingAdvice": shoppingAdvice}
+         for sourceUser, targetUser, shoppingAdvice in pairs])
+    return [outbox.OutboundMail(sender=SANTABOT_SEND_FROM, body=body, html=html,
+                subject="Secret Santa Result for {sourceName}".format(sourceName=sourceUser.name),
+                to="{sourceName} <{sourceEmail}>".format(sourceName=sourceUser.name, sourceEmail=sourceUser.email))
+            for (sourceUser, targetUser, shoppingAdvice), (body, html) in zip(pairs, rendered)]
+
+def mail_welcome(userObj=None, groupObj=None):
+    import outbox
+    (body, html), = renderMails("welcome", groupObj, [{"name": userObj.name}])
+    return outbox.OutboundMail(sender=SANTABOT_SEND_FROM, body=body, html=html,
+        subject="Welcome to the Secret Santa group {groupName}".format(groupName=groupObj.name),
+        to="{name} <{email}>".format(name=userObj.name, email=userObj.email))
+
+def send_mails(messages):
+    """ Stores the messages and queues them for the mail worker """
+    queue_mails(ndb.put_multi(messages))
+
+def send_mails_once(messages, name):
+    """ send_mails for messages with fixed keys, which may have been sent
+    before: stored ones aren't stored again, and the batches' tasks are
+    named after name, so they're only ever queued once """
+    stored = ndb.get_multi([m.key for m in messages])
+    ndb.put_multi([m for m, old in zip(messages, stored) if old is None])
+    queue_mails([m.key for m in messages], name)
+
+def queue_mails(keys, name=None):
+    batchSize = app.config['MAIL_BATCH_SIZE']
+    for i in range(0, len(keys), batchSize):
+        enqueueTask('send_mail_task', queueName="mail", name="{}-{}".format(name, i // batchSize) if name else None,
+            keys=",".join(k.urlsafe() for k in keys[i:i + batchSize]))
 
+#
+# View models. Templates get plain rows, resolved from entities fetched in
+# one batch, so rendering never goes back to the datastore.
+#
+def memberRows(regs, people):
+    """ A row per registration: who, who they avoid, and when """
+    rows = []
+    for reg in regs:
+        person = people.get(reg.person)
+        if person is None:
+            # Their record is gone; see migrate_people_task
+            continue
+        rows.append({"name": person.name, "email": person.email,
+            "avoiding": [people[k].name for k in reg.prohibitedPeople if people.get(k)],
+            "createDate": reg.createDate, "completionDate": reg.completionDate})
+    return rows
+
+def pairRows(pairs, regs, people):
+    """ A row per pairing, giver and giftee by name """
+    personByReg = dict((reg.key, reg.person) for reg in regs)
+    rows = []
+    for pair in pairs:
+        source = people.get(personByReg.get(pair.source))
+        target = people.get(pair.targetPerson or personByReg.get(pair.target))
+        if source and target:
+            rows.append({"source": source.name, "target": target.name})
+    return rows
+
+def ownerView(regs, people, matching):
+    """ What the owner's panel on the group page shows """
+    view = {"members": memberRows(regs, people), "feasible": None}
+    if matching:
+        view["feasible"] = matching.feasible
+        view["blockedSources"] = [people[k].name for k in matching.blockedSources if people.get(k)]
+        view["blockedTargets"] = [people[k].name for k in matching.blockedTargets if people.get(k)]
+    return view
+
+def runDetails(group):
+    """ Everything the admin's run details show, in a fixed number of RPCs:
+    the registrations and pairs at once, then everyone they mention """
+    regsFuture = registrationsQuery(group.key).fetch_async()
+    pairsFuture = ndb.get_multi_async(group.pairs)
+    regs = regsFuture.get_result()
+    pairs = [f.get_result() for f in pairsFuture]
+    pairs = [pair for pair in pairs if pair]
+
+    keys = []
+    for reg in regs:
+        keys.append(reg.person)
+        keys.extend(reg.prohibitedPeople)
+    people = getEntityMap(keys)
+    return {"members": memberRows(regs, people), "pairs": pairRows(pairs, regs, people)}
 
 #
 # WebApp Endpoints
@@ -160,19 +560,16 @@ def mainPage():
         oldGroups = []
 
         if userObj:
-            # Get all santa groups the current user is in
-            for reg in SantaRegistration.query(SantaRegistration.person == userObj.key, ancestor=registrationKey):
-                group = reg.group.get()
-                groupObj = {"group":group, "pair":None}
-
-                if group.createDate < oldAgeCutoff:
-                    oldGroups.append(groupObj)
+            # All santa groups the current user is in
+            memberships = SantaMemberships.keyFor(userObj.userId).get()
+            if memberships is None:
+                memberships = build_memberships(userObj)
+
+            for summary in sorted(memberships.groups, reverse=True, key=lambda x: x.createDate):
+                if summary.createDate < oldAgeCutoff:
+                    oldGroups.append(summary)
                 else:
-                    recentGroups.append(groupObj)
-
-                logging.debug("Group: %s %s", str(group), reg )
-
-        # memberGroups = sorted(memberGroups, reverse=True, key=lambda x: x['group'].createDate)
+                    recentGroups.append(summary)
 
         return render_template('index.html', users=users, userRecord=userObj,
             recentGroups=recentGroups, oldGroups=oldGroups)
@@ -211,44 +608,93 @@ def view_group(groupId):
         
         grpObj = ndb.Key(urlsafe=groupId).get()
         if grpObj is None:
+            movedId = getMovedGroupId(groupId)
+            if movedId:
+                return redirect(url_for('view_group', groupId=movedId))
             abort(404)
 
-        target = None
+        pair = None
+        matching = None
         others = []
         members = []
         registrants = []
+        people = {}
         myReg = None
-
-        if userObj:
-            for reg in SantaRegistration.query(SantaRegistration.group == grpObj.key, ancestor=registrationKey):
-                person = reg.person.get()
+        ownerRecord = None
+
+        if userObj and grpObj.runDate:
+            # Finished groups: one keyed get finds the current user's giftee
+            keys = [SantaPairing.keyFor(grpObj.key, userObj.key)]
+            if grpObj.owner:
+                keys.append(grpObj.owner)
+            entities = ndb.get_multi(keys)
+            pair = entities[0]
+            if grpObj.owner:
+                ownerRecord = entities[1]
+
+        # Everyone but the owner is done once they have their result
+        if userObj and not (pair and grpObj.ownerId != userObj.userId):
+            registrants = registrationsQuery(grpObj.key).fetch()
+
+            # Everyone the templates mention, and the pairs, in one batch
+            keys = [grpObj.owner] + list(grpObj.pairs)
+            for reg in registrants:
+                keys.append(reg.person)
+                keys.extend(reg.prohibitedPeople)
+            if grpObj.ownerId == userObj.userId and not grpObj.runDate:
+                keys.append(SantaGroupMatching.keyFor(grpObj.key))
+            entities = getEntityMap(keys)
+            matching = entities.get(SantaGroupMatching.keyFor(grpObj.key))
+
+            people = dict((k, v) for k, v in entities.items() if k.kind() == SantaPerson._get_kind())
+            ownerRecord = people.get(grpObj.owner)
+            regsByKey = dict((reg.key, reg) for reg in registrants)
+
+            for reg in registrants:
+                person = people.get(reg.person)
+                if person is None:
+                    continue
                 members.append(person)
-                registrants.append(reg)
                 if person != userObj:
                     others.append(person)
                 else:
                     myReg = reg
 
-            for pairKey in grpObj.pairs:
-                pair = pairKey.get()
-                # logging.info("Checking pair %s", pair)
-                if pair.source.get().person == userObj.key:
-                    # logging.info("Checking against %s", userObj)
-                    target = pair.target.get()
+            # Runs from before pairs were keyed by person have to be searched
+            if pair is None:
+                for pairKey in grpObj.pairs:
+                    candidate = entities.get(pairKey)
+                    sourceReg = regsByKey.get(candidate.source) if candidate else None
+                    targetReg = regsByKey.get(candidate.target) if candidate else None
+                    if sourceReg is None or targetReg is None or sourceReg.person != userObj.key:
+                        continue
+                    pair = candidate
+                    target = people.get(targetReg.person)
+                    pair.targetPerson = targetReg.person
+                    pair.targetName = target.name if target else ""
+                    pair.targetAdvice = getShoppingAdvice([targetReg])[targetReg.key]
+                    break
+
+        if ownerRecord is None:
+            ownerRecord = getUserRecord(grpObj.ownerId)
 
         if grpObj.registering:
             # Registration is open
             template = "group-registering.html"
-        elif target:
+        elif pair:
             # The run completed, and they are santa for someone
             template = "group-result.html"
         else:
             # Registration is closed, they need to enter wishlist
             template = "group-complete.html"
 
-        return render_template(template, users=users, userRecord=getCurrentUserRecord(),
-            ownerRecord=getUserRecord(grpObj.ownerId), group=grpObj, myReg=myReg, target=target, others=others, members=members,
-            registrants=registrants)
+        owner = None
+        if userObj and grpObj.ownerId == userObj.userId:
+            owner = ownerView(registrants, people, matching)
+
+        return render_template(template, users=users, userRecord=userObj,
+            ownerRecord=ownerRecord, group=grpObj, myReg=myReg, pair=pair, others=others, members=members,
+            registrants=registrants, people=people, owner=owner)
     except(Unregistered):
         return createUserProfile(url_for('view_group', groupId=groupId))
 
@@ -257,6 +703,9 @@ def join_group(groupId):
     try:
         grpObj = ndb.Key(urlsafe=groupId).get()
         if grpObj is None:
+            movedId = getMovedGroupId(groupId)
+            if movedId:
+                return redirect(url_for('join_group', groupId=movedId))
             abort(404)
 
         userObj = getCurrentUserRecord()
@@ -264,24 +713,21 @@ def join_group(groupId):
             return redirect(users.create_login_url(url_for('join_group', groupId=groupId)))
 
         # Dedupe
-        if SantaRegistration.query(SantaRegistration.group == grpObj.key, SantaRegistration.person == userObj.key, ancestor=registrationKey).get():
-            return redirect(url_for('view_group', groupId=grpObj.key.urlsafe()))
-
-        reg = SantaRegistration(parent=registrationKey, group=grpObj.key, person=userObj.key)
+        try:
+            if not register_member(grpObj.key, userObj):
+                return redirect(url_for('view_group', groupId=grpObj.key.urlsafe()))
+        except GroupMigrating:
+            flash("{} is being moved. Try joining again in a minute.".format(grpObj.name), "info")
+            return redirect(url_for('mainPage'))
 
         # Send email
-        message = mail.EmailMessage(sender=SANTABOT_SEND_FROM)
-        message.subject = "Welcome to the Secret Santa group {groupName}".format(name=userObj.name, groupName=grpObj.name)
-        message.to = "{name} <{email}>".format(name=userObj.name, email=userObj.email)
-        message.body = render_template('email-welcome.txt', name=userObj.name, groupName=grpObj.name, groupPage=url_for('view_group', groupId=groupId, _external=True))
-        message.html = render_template('email-welcome.html', name=userObj.name, groupName=grpObj.name, groupPage=url_for('view_group', groupId=groupId, _external=True))
-        message.send()
+        message = mail_welcome(userObj=userObj, groupObj=grpObj)
+        send_mails([message])
         logging.debug("MESSAGE BODY: " + message.body)
 
         logging.info("User {} joined {}".format(userObj.name, grpObj.name))
 
-
-        reg.put()
+        update_memberships([userObj], grpObj, completed=False)
 
         # Tell the user
         flash("Joined group " + grpObj.name, "success")
@@ -302,10 +748,18 @@ def advice_for_group(groupId):
     if groupObj.ownerId != userObj.userId:
         abort(401)
 
-    groupObj.advice = request.form['value']
-    groupObj.put()
+    try:
+        set_group_advice(groupObj.key, request.form['value'])
+    except GroupMigrating:
+        return "Busy", 503
     return "Updated"
 
+@ndb.transactional
+def set_group_advice(groupKey, advice):
+    group = checkNotMigrating(groupKey)
+    group.advice = advice
+    group.put()
+
 @app.route('/group/<groupId>/ready', methods=['POST'])
 def ready_group(groupId):
     grpObj = ndb.Key(urlsafe=groupId).get()
@@ -328,28 +782,117 @@ def ready_group(groupId):
     # if "unchecked1" in request.form:
     #     logging.info("CHK1 %s", request.form['unchecked1'])
 
-    reg = SantaRegistration.query(SantaRegistration.group == grpObj.key, SantaRegistration.person == userObj.key, ancestor=registrationKey).get()
-    reg.shoppingAdvice = shoppingAdvice
-    reg.completionDate = datetime.datetime.now()
-    del reg.prohibitedPeople[:]
+    prohibited = []
     if "unchecked0" in request.form:
-        reg.prohibitedPeople.append(ndb.Key(urlsafe=request.form['unchecked0']))
+        prohibited.append(ndb.Key(urlsafe=request.form['unchecked0']))
     if "unchecked1" in request.form:
-        reg.prohibitedPeople.append(ndb.Key(urlsafe=request.form['unchecked1']))
-    reg.put()
+        prohibited.append(ndb.Key(urlsafe=request.form['unchecked1']))
 
-    # If this was the last registration, the run is ready
-    qry = SantaRegistration.query(SantaRegistration.group == grpObj.key, SantaRegistration.completionDate == None , ancestor=registrationKey)
+    try:
+        allDone = submit_list(grpObj.key, userObj, shoppingAdvice, prohibited)
+    except GroupMigrating:
+        flash("{} is being moved. Send your list again in a minute.".format(grpObj.name), "info")
+        return redirect(url_for('view_group', groupId=groupId))
+    update_memberships([userObj], grpObj, completed=True)
 
     logging.info("User {} is ready for {} with advice {}".format(userObj.name, grpObj.name, shoppingAdvice))
     
-    if not qry.iter().has_next():
+    # If this was the last registration, the run is ready
+    if allDone:
         logging.info("It looks like all registrations are done.")
 
         group_run(grpObj.key.urlsafe())
 
     return "OK"
 
+def get_counts(groupKey):
+    """ The group's counters. new_group stores them; they're only counted
+    from scratch for groups from before they were kept. """
+    counts = SantaGroupCounts.keyFor(groupKey).get()
+    if counts is None:
+        regs = registrationsQuery(groupKey).fetch(projection=[SantaRegistration.completionDate])
+        counts = SantaGroupCounts(key=SantaGroupCounts.keyFor(groupKey), members=len(regs),
+            completed=len([reg for reg in regs if reg.completionDate]))
+    return counts
+
+def get_matching(groupKey):
+    """ The group's running assignment. new_group stores it; it's only
+    built from the registrations for groups from before it was kept. """
+    matching = SantaGroupMatching.keyFor(groupKey).get()
+    if matching is None:
+        from people_matcher import IncrementalMatcher
+        regs = registrationsQuery(groupKey).fetch()
+        matcher = IncrementalMatcher()
+        for reg in regs:
+            matcher.addPerson(reg.person.urlsafe())
+        for reg in regs:
+            if reg.prohibitedPeople:
+                matcher.setProhibited(reg.person.urlsafe(), [k.urlsafe() for k in reg.prohibitedPeople])
+        matching = SantaGroupMatching(key=SantaGroupMatching.keyFor(groupKey))
+        matching.update(matcher)
+    return matching
+
+class GroupMigrating(Exception):
+    """ The group is being copied to its new key """
+    pass
+
+def checkNotMigrating(groupKey):
+    """ Returns the group, or raises GroupMigrating if migrate_group is
+    copying it. Read in a transaction, so a migration waits for the change
+    or sees it. A group that's gone has just been moved. """
+    group = groupKey.get()
+    if group is None or group.migrating:
+        raise GroupMigrating()
+    return group
+
+@ndb.transactional(xg=True)
+def register_member(groupKey, person):
+    """ Adds the person to the group and counts them, unless they're
+    already in it. Returns the new registration. """
+    checkNotMigrating(groupKey)
+    if getRegistration(groupKey, person):
+        return None
+
+    counts = get_counts(groupKey)
+    counts.members = counts.members + 1
+
+    matching = get_matching(groupKey)
+    matcher = matching.matcher()
+    matcher.addPerson(person.key.urlsafe())
+    matching.update(matcher)
+
+    reg = newRegistration(groupKey, person)
+    ndb.put_multi([reg, counts, matching])
+    return reg
+
+@ndb.transactional(xg=True)
+def submit_list(groupKey, person, shoppingAdvice, prohibited):
+    """ Saves a member's list and no-list. Returns True for exactly one
+    submission: the one that completes the group. """
+    checkNotMigrating(groupKey)
+    reg = getRegistration(groupKey, person)
+    if reg is None:
+        abort(404)
+
+    counts = get_counts(groupKey)
+
+    firstTime = reg.completionDate is None
+    reg.shoppingAdvice = None
+    reg.completionDate = datetime.datetime.now()
+    reg.prohibitedPeople = prohibited
+    if firstTime:
+        counts.completed = counts.completed + 1
+
+    # Only the pairs this no-list breaks get repaired
+    matching = get_matching(groupKey)
+    matcher = matching.matcher()
+    matcher.setProhibited(person.key.urlsafe(), [k.urlsafe() for k in prohibited])
+    matching.update(matcher)
+
+    wishList = SantaWishList(key=SantaWishList.keyFor(reg.key), advice=shoppingAdvice)
+    ndb.put_multi([reg, counts, wishList, matching])
+    return firstTime and counts.completed >= counts.members
+
 @app.route('/group/new', methods=['POST'])
 def new_group():
     userObj = getCurrentUserRecord()
@@ -367,10 +910,15 @@ def new_group():
         flash("The group name is too short.","error")
         return redirect(url_for('mainPage'))
 
-    group = SantaGroup.query(SantaGroup.name==groupName, ancestor=groupsKey).get()
+    group = SantaGroup.query(SantaGroup.name==groupName).get()
     if group is None:
-        group = SantaGroup(parent=groupsKey, name=groupName, owner=userObj.key, ownerId=userObj.userId, registering=True)
-        group.put()
+        # Its counters start out with it, so the first join needn't count
+        first, last = SantaGroup.allocate_ids(1)
+        group = SantaGroup(id=first, name=groupName, owner=userObj.key, ownerId=userObj.userId, registering=True)
+        counts = SantaGroupCounts(key=SantaGroupCounts.keyFor(group.key))
+        matching = SantaGroupMatching(key=SantaGroupMatching.keyFor(group.key))
+        matching.update(matching.matcher())
+        ndb.put_multi([group, counts, matching])
 
         logging.info("Created group " + groupName)
         flash("Created group " + groupName, "success")
@@ -387,25 +935,22 @@ def close_registration(groupId):
 
     groupObj = ndb.Key(urlsafe=groupId).get()
 
-    if groupObj.ownerId != userObj.userId:
-        abort(401)    
-
     # Error check
     if groupObj is None:
         abort(404)
 
-    if SantaRegistration.query(SantaRegistration.group == groupObj.key, ancestor=registrationKey).count() < 3:
+    if groupObj.ownerId != userObj.userId:
+        abort(401)    
+
+    if get_counts(groupObj.key).members < 3:
         flash("You need at least three people to close the group.", "error")
         return redirect(url_for('view_group', groupId=groupId))
 
-
-    groupObj.registering = False
-    groupObj.put()
-
-    for reg in SantaRegistration.query(SantaRegistration.group == groupObj.key, ancestor=registrationKey):
-        userObj = reg.person.get()
-        # Send email
-        send_mail_close_registration(userObj=userObj, groupObj=groupObj)
+    try:
+        groupObj = close_group(groupObj.key, request.url_root)
+    except GroupMigrating:
+        flash("{} is being moved. Try closing it again in a minute.".format(groupObj.name), "info")
+        return redirect(url_for('view_group', groupId=groupId))
 
     flash("Registration is now complete for {}".format(groupObj.name), "info")
     logging.info("User {} closed registration for {}".format(userObj.name, groupObj.name))
@@ -413,6 +958,41 @@ def close_registration(groupId):
 
     return redirect(url_for('view_group', groupId=groupId))
 
+@ndb.transactional
+def close_group(groupKey, baseUrl):
+    """ Closes registration, and queues the emails telling everyone if it
+    was open. Returns the group. """
+    group = checkNotMigrating(groupKey)
+    if not group.registering:
+        return group
+    group.registering = False
+    group.put()
+    enqueueTask('group_closed_task', transactional=True, groupId=groupKey.urlsafe(), baseUrl=baseUrl)
+    return group
+
+@app.route('/admin/task/group_closed', methods=['POST'])
+def group_closed_task():
+    """ Emails everyone that registration closed, and updates their home
+    pages. Each message is keyed by its registration, so a retry only
+    queues what didn't go out. """
+    import outbox
+    groupKey = ndb.Key(urlsafe=request.form['groupId'])
+    # Links in the emails should point wherever the group was closed from
+    with app.test_request_context(base_url=request.form['baseUrl']):
+        group = groupKey.get()
+        if group is None:
+            return "OK"
+        regs = registrationsQuery(groupKey).fetch(projection=[SantaRegistration.person])
+        people = getEntityMap([reg.person for reg in regs])
+        regs = [reg for reg in regs if people.get(reg.person)]
+
+        messages = mail_close_registration(people=[people[reg.person] for reg in regs], groupObj=group)
+        for reg, message in zip(regs, messages):
+            message.key = ndb.Key(outbox.OutboundMail, "close-" + reg.key.urlsafe())
+        send_mails_once(messages, "close-" + groupKey.urlsafe())
+        update_memberships([people[reg.person] for reg in regs], group)
+    return "OK"
+
 @app.route('/group/<groupId>/run')
 def group_run_owner(groupId):
     userObj = getCurrentUserRecord()
@@ -432,22 +1012,130 @@ def group_run(groupId):
     if group is None:
         abort(404)
 
-    # Don't run if we've already run.
-    if group.runDate:
+    # Don't run if we've already run. A run that got as far as emailing
+    # has a date, but may have to be started again.
+    if group.runDate and group.runStatus not in RUN_IN_PROGRESS:
         logging.info("This has already run. {}".format(group.runDate))
         flash("{} has already run.".format(group.name), "info")
-        return redirect(url_for('view_group', groupId=groupId))    
+        return
 
+    try:
+        queued = queue_group_run(group.key, request.url_root)
+    except GroupMigrating:
+        flash("{} is being moved. Try running it again in a minute.".format(group.name), "info")
+        return
+    if queued:
+        flash("Running {}. Results will be emailed shortly.".format(group.name), "success")
+    else:
+        flash("{} is already running.".format(group.name), "info")
+
+@ndb.transactional
+def queue_group_run(groupKey, baseUrl):
+    """ Marks the group pending and starts the background run, unless it's
+    already under way or done. A run whose lease ran out lost its task, and
+    is started again from the stage it got to. """
+    group = groupKey.get()
+    if group.migrating:
+        raise GroupMigrating()
+    if group.runDate and group.runStatus not in RUN_IN_PROGRESS:
+        return False
+    if group.runStatus in RUN_IN_PROGRESS and (group.runLeaseUntil is None
+            or group.runLeaseUntil > datetime.datetime.now()):
+        return False
+
+    if group.runStatus not in RUN_IN_PROGRESS:
+        group.runStatus = RUN_PENDING
+    group.put()
+    enqueueTask('group_run_task', queueName="runs", transactional=True, groupId=groupKey.urlsafe(), baseUrl=baseUrl)
+    return True
 
-    pm = PeopleMatcher()
+class RunBusy(Exception):
+    """ Another run task holds the group's lease """
+    pass
 
-    for reg in SantaRegistration.query(SantaRegistration.group == group.key, ancestor=registrationKey):
+@app.route('/admin/task/group_run', methods=['POST'])
+def group_run_task():
+    groupKey = ndb.Key(urlsafe=request.form['groupId'])
+    # The task's name stays the same when it's retried, so a retry gets its
+    # own lease back rather than waiting for it to run out
+    runner = request.headers.get('X-AppEngine-TaskName') or uuid.uuid4().hex
+    # Links in the emails should point wherever the run was started from
+    with app.test_request_context(base_url=request.form['baseUrl']):
+        try:
+            run_group(groupKey, runner)
+        except RunBusy:
+            # Try again once the other task is done, or its lease runs out
+            return "Busy", 503
+    return "OK"
+
+@ndb.transactional
+def lease_run(groupKey, runner):
+    """ Gives runner the group's run. Returns the group, or None if there's
+    nothing left to do; raises RunBusy if another runner has it. """
+    group = groupKey.get()
+    if group is None or group.runStatus not in RUN_IN_PROGRESS:
+        return None
+
+    now = datetime.datetime.now()
+    if group.runLeaseOwner and group.runLeaseOwner != runner and group.runLeaseUntil > now:
+        raise RunBusy()
+    group.runLeaseOwner = runner
+    group.runLeaseUntil = now + RUN_LEASE
+    group.put()
+    return group
+
+@ndb.transactional
+def advance_run(groupKey, runner, fromStatus, toStatus, **changes):
+    """ Moves the run on from fromStatus, if runner still has it. Finished
+    runs give up the lease. Returns the group. """
+    group = groupKey.get()
+    if group.runLeaseOwner != runner or group.runStatus != fromStatus:
+        raise RunBusy()
+
+    group.runStatus = toStatus
+    group.populate(**changes)
+    if toStatus in RUN_IN_PROGRESS:
+        group.runLeaseUntil = datetime.datetime.now() + RUN_LEASE
+    else:
+        group.runLeaseOwner = None
+        group.runLeaseUntil = None
+    group.put()
+    return group
+
+def run_group(groupKey, runner):
+    """ Takes the group's run from whatever stage it got to. A retried task
+    picks up after the last stage that finished. """
+    group = lease_run(groupKey, runner)
+    if group is None:
+        return
+
+    if group.runStatus == RUN_PENDING:
+        group = advance_run(groupKey, runner, RUN_PENDING, RUN_SOLVING)
+    if group.runStatus == RUN_SOLVING:
+        group = solve_run(group, runner)
+    if group.runStatus == RUN_EMAILING:
+        group = email_run(group, runner)
+
+def solve_run(group, runner):
+    """ Works out and stores the pairs. Nobody sees them until the group
+    moves on to emailing, so a retry that solves again is harmless. """
+    from people_matcher import PeopleMatcher
+    pm = PeopleMatcher(engine=PeopleMatcher.ENGINE_MATCHING)
+
+    # Everything the run needs comes from this one query
+    regsByPerson = {}
+    for reg in registrationsQuery(group.key):
         pm.addPerson(reg.person, prohibited=reg.prohibitedPeople)
+        regsByPerson[reg.person] = reg
         # Don't run if anyone hasn't registered.
         if not reg.completionDate:
-            flash("Not everyone has completed signup.", "warning")
-            return redirect(url_for('view_group', groupId=groupId))    
+            logging.info("Not everyone in {} has completed signup.".format(group.name))
+            return advance_run(group.key, runner, RUN_SOLVING, RUN_INCOMPLETE)
 
+    # Start from the assignment kept while the lists came in
+    matching = SantaGroupMatching.keyFor(group.key).get()
+    if matching and matching.feasible:
+        pm.setWarmStart(matching.warmStart())
 
     graphSegments = None
 
@@ -457,50 +1145,143 @@ def group_run(groupId):
         # logging.info(pm)
 
         graphSegments = pm.execute()
-        if graphSegments:
+        if graphSegments is not None:
             break
 
+        logging.warning("Can't honor {} prohibitions for {}: {} people can only give to {}".format(
+            i, group.name, len(pm.hallViolation["sources"]), len(pm.hallViolation["targets"])))
+
     # At this point we should have the graph
     if graphSegments is None:
-        raise Exception("Could not solve", pm)
+        logging.error("Could not solve {}: {}".format(group.name, pm))
+        return advance_run(group.key, runner, RUN_SOLVING, RUN_FAILED)
 
-    # Clear out pairs
-    del group.pairs[:]
+    people = getEntityMap(regsByPerson.keys())
+    advice = getShoppingAdvice(regsByPerson.values())
 
+    pairs = []
     for segment in graphSegments:
-        sourceReg = SantaRegistration.query(SantaRegistration.person == segment["source"], SantaRegistration.group == group.key, ancestor=registrationKey).get()
-        targetReg = SantaRegistration.query(SantaRegistration.person == segment["target"], SantaRegistration.group == group.key, ancestor=registrationKey).get()
-
-        logging.debug("{} ==> {}".format(segment["source"].get().email, segment["target"].get().email))
+        sourceReg = regsByPerson[segment["source"]]
+        targetReg = regsByPerson[segment["target"]]
+        targetUser = people[segment["target"]]
+
+        logging.debug("{} ==> {}".format(people[segment["source"]].email, targetUser.email))
+
+        pairs.append(SantaPairing(key=SantaPairing.keyFor(group.key, segment["source"]),
+            source=sourceReg.key, target=targetReg.key,
+            targetPerson=targetUser.key, targetName=targetUser.name, targetAdvice=advice[targetReg.key]))
+
+    # Pair keys are fixed by their giver, so a second try overwrites the first
+    ndb.put_multi(pairs)
+    return advance_run(group.key, runner, RUN_SOLVING, RUN_EMAILING,
+        pairs=[pair.key for pair in pairs], runDate=datetime.datetime.now())
+
+def email_run(group, runner):
+    """ Sends everyone their result. Each message is keyed by its pair, so
+    a retry only queues what didn't go out the first time. """
+    import outbox
+    pairs = [pair for pair in ndb.get_multi(group.pairs) if pair]
+    regs = getEntityMap([pair.source for pair in pairs])
+    people = getEntityMap([regs[pair.source].person for pair in pairs] + [pair.targetPerson for pair in pairs])
+
+    messages = mail_result(pairs=[(people[regs[pair.source].person], people[pair.targetPerson], pair.targetAdvice)
+        for pair in pairs], groupObj=group)
+    for pair, message in zip(pairs, messages):
+        message.key = ndb.Key(outbox.OutboundMail, "result-" + pair.key.urlsafe())
+    send_mails_once(messages, "result-" + group.key.urlsafe())
+    update_memberships(people.values(), group)
+
+    logging.info("Done! Sent %i emails for %s." % (len(pairs), group.name))
+    return advance_run(group.key, runner, RUN_EMAILING, RUN_DONE)
+
+@app.route('/admin/task/send_mail', methods=['POST'])
+def send_mail_task():
+    import outbox
+    keys = [ndb.Key(urlsafe=k) for k in request.form['keys'].split(",")]
+    transport = app.config['MAIL_TRANSPORT'] or outbox.AppEngineTransport()
+    if not outbox.deliver(keys, transport):
+        # The queue tries again later, with backoff
+        return "Retry", 500
+    return "OK"
 
-        santa_pair = SantaPairing(parent=group.key, source=sourceReg.key, target=targetReg.key)
-        santa_pair.put()
-        group.pairs.append(santa_pair.key)
+def isMemberAvatar(avatarHash):
+    """ Whether someone we have uses this avatar """
+    return SantaPerson.query(SantaPerson.avatarHash == avatarHash).get(keys_only=True) is not None
 
-    group.runDate = datetime.datetime.now()
-    group.put()
+@app.route('/avatar/<avatarHash>')
+def avatar(avatarHash):
+    """ A member's avatar, from this instance's cache when it can be """
+    global _avatarCache
+    if len(avatarHash) != 32 or avatarHash.strip(string.hexdigits):
+        abort(404)
+    size = avatars.servedSize(request.args.get('s', 80, type=int))
 
-    for pairKey in group.pairs:
-        pair = pairKey.get()
+    if _avatarCache is None:
+        _avatarCache = avatars.AvatarCache(app.config['AVATAR_CACHE_SIZE'])
+    fetcher = app.config['AVATAR_FETCHER'] or avatars.GravatarFetcher()
+    try:
+        image = _avatarCache.get(avatarHash, size, fetcher, isKnown=isMemberAvatar)
+    except Exception as e:
+        logging.warning("Couldn't fetch avatar {}: {}".format(avatarHash, e))
+        return redirect(avatars.gravatarUrl(avatarHash, size))
+    if image is None:
+        abort(404)
 
-        logging.debug("PAIR: " + str(pair))
-        sourceReg = pair.source.get()
-        sourceUser = sourceReg.person.get()
-        targetReg = pair.target.get()
-        targetUser = targetReg.person.get()
+    response = flask.make_response(image.body)
+    response.headers["Content-Type"] = image.contentType
+    response.headers["Cache-Control"] = "public, max-age=604800"
+    response.set_etag(image.etag)
+    return response.make_conditional(request)
 
-        send_mail_result(sourceUser=sourceUser, targetUser=targetUser, groupObj=group, targetReg=targetReg)
+@app.route('/group/<groupId>/status')
+def group_status(groupId):
+    """ Cheap enough for the group page to poll while a run is going """
+    group = ndb.Key(urlsafe=groupId).get()
+    if group is None:
+        abort(404)
 
-    flash("Done! Sent %i emails." % len(group.pairs), "success")    
+    return jsonify(runStatus=group.runStatus, runDate=group.runDate.isoformat() if group.runDate else None)
 
 
 @app.route('/admin')
 def admin_list():
-    structure=[]
-
-    groups = SantaGroup.query(ancestor=groupsKey)
-
-    return render_template('admin-list.html', users=users, userGet=getUserRecord, userRecord=getCurrentUserRecord(), groups=groups)
+    sort = request.args.get('sort', 'created')
+    if sort not in ADMIN_SORTS:
+        abort(404)
+    cursor = Cursor(urlsafe=request.args['cursor']) if request.args.get('cursor') else None
+
+    # Keys, then the groups by key: a projection would leave out groups
+    # stored without one of its properties, and gets come from memcache
+    qry = SantaGroup.query().order(ADMIN_SORTS[sort]())
+    groupKeys, nextCursor, more = qry.fetch_page(ADMIN_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+    groups = [group for group in ndb.get_multi(groupKeys) if group]
+
+    # The page's owners in one batch
+    people = getEntityMap([group.owner for group in groups])
+    owners = {}
+    for group in groups:
+        owners[group.key] = people.get(group.owner) or getUserRecord(group.ownerId)
+
+    return render_template('admin-list.html', users=users, userRecord=getCurrentUserRecord(), groups=groups, owners=owners,
+        sort=sort, sorts=sorted(ADMIN_SORTS.keys()), nextCursor=nextCursor.urlsafe() if more and nextCursor else None)
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    """ What each endpoint has cost on this instance lately """
+    endpoints = request_metrics.snapshot()
+    rows = []
+    for name, stats in sorted(endpoints.items(), key=lambda item: -item[1].totalMs):
+        rows.append({"endpoint": name, "requests": stats.requests, "errors": stats.errors,
+            "meanMs": stats.totalMs / stats.requests,
+            "p50": stats.percentile(50), "p90": stats.percentile(90), "p99": stats.percentile(99),
+            "histogram": stats.latency, "rpcs": stats.perRequest(stats.rpcs),
+            "timings": stats.perRequest(stats.timings)})
+
+    if request.args.get('format') == 'json':
+        return jsonify(windowMinutes=request_metrics.WINDOW_MINUTES, buckets=request_metrics.LATENCY_BUCKETS,
+            endpoints=rows)
+    return render_template('admin-metrics.html', users=users, userRecord=getCurrentUserRecord(), rows=rows,
+        windowMinutes=request_metrics.WINDOW_MINUTES, buckets=request_metrics.LATENCY_BUCKETS)
 
 @app.route('/admin/group/<groupId>')
 def admin_list_runs(groupId):
@@ -508,27 +1289,445 @@ def admin_list_runs(groupId):
     if groupObj is None:
         abort(404)
 
-    pairs = SantaPairing.query(ancestor=groupObj.key)
-    regs = SantaRegistration.query(SantaRegistration.group == groupObj.key, ancestor=registrationKey)
+    details = runDetails(groupObj)
+    return render_template('admin-run-details.html', users=users, userRecord=getCurrentUserRecord(), group=groupObj,
+        members=details["members"], pairs=details["pairs"])
+
+@app.route('/admin/cron/daily')
+def admin_cron_daily():
+    # Starts today's sweep, or nudges it along if it stalled
+    sweep = DailySweep.get_or_insert(datetime.date.today().isoformat())
+    if not sweep.doneDate:
+        name = "daily-{}-{}".format(sweep.key.id(), sweep.pages)
+        if sweep.updateDate is None or datetime.datetime.now() - sweep.updateDate > SWEEP_STALL:
+            # That page's task name is used up; a new one gets a new task
+            sweep.nudges = sweep.nudges + 1
+            sweep.put()
+            name = "{}-{}".format(name, sweep.nudges)
+        enqueueTask('daily_sweep_task', name=name, sweepId=sweep.key.id())
+
+    return "OK {}".format(sweepStats(sweep))
+
+@app.route('/admin/task/daily_sweep', methods=['POST'])
+def daily_sweep_task():
+    """ Hands one page of closed, unrun groups to per-group reminder tasks,
+    then queues the next page """
+    sweep = DailySweep.get_by_id(request.form['sweepId'])
+    if sweep is None or sweep.doneDate:
+        return "OK"
+
+    qry = SantaGroup.query(SantaGroup.registering == False, SantaGroup.runDate == None)
+    cursor = Cursor(urlsafe=sweep.cursor) if sweep.cursor else None
+    groupKeys, nextCursor, more = qry.fetch_page(SWEEP_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+
+    # Task names keep a retried page from reminding anyone twice
+    for groupKey in groupKeys:
+        enqueueTask('daily_reminders_task', name="remind-{}-{}".format(sweep.key.id(), groupKey.urlsafe()),
+            sweepId=sweep.key.id(), groupId=groupKey.urlsafe())
+
+    sweep.cursor = nextCursor.urlsafe() if nextCursor else None
+    sweep.pages = sweep.pages + 1
+    sweep.groups = sweep.groups + len(groupKeys)
+    if not more:
+        sweep.doneDate = datetime.datetime.now()
+    sweep.put()
+
+    logging.info("DAILY: {}".format(sweepStats(sweep)))
+
+    if more:
+        enqueueTask('daily_sweep_task', name="daily-{}-{}".format(sweep.key.id(), sweep.pages), sweepId=sweep.key.id())
+    return "OK"
+
+@app.route('/admin/task/daily_reminders', methods=['POST'])
+def daily_reminders_task():
+    group = ndb.Key(urlsafe=request.form['groupId']).get()
+    if group is None or group.registering or group.runDate:
+        return "OK"
 
+    regs = registrationsQuery(group.key, SantaRegistration.completionDate == None).fetch(projection=[SantaRegistration.person])
+    people = ndb.get_multi([reg.person for reg in regs])
+    for person in people:
+        logging.info("DAILY: reg {} for {} is not completed".format(group.name, person.name))
 
-    # logging.info("groupObj Obj: %s", groupObj)
+    send_mails(mail_close_registration(groupObj=group, people=people))
 
-    return render_template('admin-run-details.html', users=users, userRecord=getCurrentUserRecord(), group=groupObj, pairsList=pairs, regsList=regs)
+    memcache.incr("sweep-registrations-" + request.form['sweepId'], delta=len(regs), initial_value=0)
+    return "OK"
 
-@app.route('/admin/cron/daily')
-def admin_cron_daily():
-    countReg = 0
-    for group in SantaGroup.query(SantaGroup.registering == False, SantaGroup.runDate == None, ancestor=groupsKey):
-        for reg in SantaRegistration.query(SantaRegistration.group == group.key, SantaRegistration.completionDate == None, ancestor=registrationKey):
-            logging.info("DAILY: reg {} for {} is not completed".format(group.name, reg.person.get().name))
-            userObj = reg.person.get()
-            groupObj = reg.group.get()            
-            send_mail_close_registration(groupObj=groupObj, userObj=userObj)
+def sweepStats(sweep):
+    registrations = memcache.get("sweep-registrations-" + sweep.key.id()) or 0
+    seconds = max(((sweep.doneDate or datetime.datetime.now()) - sweep.startDate).total_seconds(), 1)
+    return "{} groups, {} registrations in {:.0f}s ({:.1f} groups/s, {:.1f} registrations/s)".format(
+        sweep.groups, registrations, seconds, sweep.groups / seconds, registrations / seconds)
+
+#
+# Migrations
+#
+
+@app.route('/admin/migrate/people')
+def admin_migrate_people():
+    enqueueTask('migrate_people_task')
+    return "Started"
+
+@app.route('/admin/task/migrate_people', methods=['POST'])
+def migrate_people_task():
+    """ Moves people from under peopleKey to keys made from their user id,
+    a page at a time. An old person is only deleted by a pass that finds
+    nothing referring to it any more; passes start over until one does. """
+    cursor = Cursor(urlsafe=request.form['cursor']) if request.form.get('cursor') else None
+    people, nextCursor, more = SantaPerson.query(ancestor=peopleKey).fetch_page(MIGRATION_PAGE_SIZE, start_cursor=cursor)
+    referenced = int(request.form.get('referenced', 0))
+
+    unreferenced = [person.key for person in people if not migrate_person(person)]
+    ndb.delete_multi(unreferenced)
+    referenced = referenced + len(people) - len(unreferenced)
+    logging.info("Migrated {} people, removed {}".format(len(people), len(unreferenced)))
+
+    if more:
+        enqueueTask('migrate_people_task', cursor=nextCursor.urlsafe(), referenced=referenced)
+    elif referenced:
+        enqueueTask('migrate_people_task', countdown=MIGRATION_RECHECK_SECONDS)
+    return "OK"
+
+@app.route('/admin/migrate/memberships')
+def admin_migrate_memberships():
+    enqueueTask('backfill_memberships_task')
+    return "Started"
+
+@app.route('/admin/task/backfill_memberships', methods=['POST'])
+def backfill_memberships_task():
+    """ Builds every person's home page summary, a page at a time """
+    cursor = Cursor(urlsafe=request.form['cursor']) if request.form.get('cursor') else None
+    people, nextCursor, more = SantaPerson.query().fetch_page(MIGRATION_PAGE_SIZE, start_cursor=cursor)
+
+    for person in people:
+        build_memberships(person)
+    logging.info("Built group summaries for {} people".format(len(people)))
+
+    if more:
+        enqueueTask('backfill_memberships_task', cursor=nextCursor.urlsafe())
+    return "OK"
 
-            countReg = countReg + 1
+@app.route('/admin/migrate/groups')
+def admin_migrate_groups():
+    enqueueTask('migrate_groups_task')
+    return "Started"
+
+@app.route('/admin/task/migrate_groups', methods=['POST'])
+def migrate_groups_task():
+    """ Moves groups from under groupsKey to their own entity groups, with
+    their registrations under them, a page at a time. Run it after
+    migrate_people_task. """
+    cursor = Cursor(urlsafe=request.form['cursor']) if request.form.get('cursor') else None
+    groups, nextCursor, more = SantaGroup.query(ancestor=groupsKey).fetch_page(MIGRATION_PAGE_SIZE, start_cursor=cursor)
+
+    migrated = 0
+    for group in groups:
+        try:
+            if migrate_group(group):
+                migrated = migrated + 1
+        except Exception:
+            # Left as it was, for a later pass
+            logging.exception("Couldn't migrate group {}".format(group.name))
+    logging.info("Migrated {} groups, skipped {}".format(migrated, len(groups) - migrated))
+
+    if more:
+        enqueueTask('migrate_groups_task', cursor=nextCursor.urlsafe())
+    return "OK"
+
+@ndb.transactional
+def start_migration(groupKey):
+    """ Flags the group so nothing changes it while it's copied. Returns
+    the group, or None if it's running and has to wait for a later pass. """
+    group = groupKey.get()
+    if group is None or group.runStatus in RUN_IN_PROGRESS:
+        return None
+    group.migrating = True
+    group.put()
+    return group
+
+@ndb.transactional
+def cancel_migration(groupKey):
+    group = groupKey.get()
+    group.migrating = None
+    group.put()
+
+def sameRegistrations(regs, newRegKeys):
+    """ Whether each registration and its wish list were copied as they
+    are now. Read past the context cache, which holds what was copied. """
+    if sorted(reg.key for reg in regs) != sorted(newRegKeys.keys()):
+        return False
+    copyKeys = [newRegKeys[reg.key] for reg in regs]
+    copies = ndb.get_multi(copyKeys, use_cache=False)
+    wishLists = ndb.get_multi([SantaWishList.keyFor(reg.key) for reg in regs], use_cache=False)
+    copiedLists = ndb.get_multi([SantaWishList.keyFor(k) for k in copyKeys], use_cache=False)
+    for reg, copy, wishList, copiedList in zip(regs, copies, wishLists, copiedLists):
+        if (copy is None or reg.completionDate != copy.completionDate
+                or reg.prohibitedPeople != copy.prohibitedPeople
+                or reg.shoppingAdvice != copy.shoppingAdvice
+                or (wishList and wishList.advice) != (copiedList and copiedList.advice)):
+            return False
+    return True
+
+def migrate_group(old):
+    """ Copies one group and everything under it to a new root key, checks
+    the copy, then switches over and removes the original. Groups with a
+    run under way are left for a later pass; returns whether it moved. If
+    the copy fails, it's removed and the original is unfrozen. """
+    old = start_migration(old.key)
+    if old is None:
+        return False
+
+    first, last = SantaGroup.allocate_ids(1)
+    newKey = ndb.Key(SantaGroup, first)
+    moveKey = ndb.Key(SantaGroupMove, old.key.urlsafe())
+    try:
+        regs, people, oldPairs, oldWishLists, group = copy_group(old, newKey)
+        SantaGroupMove(key=moveKey, group=newKey).put()
+    except Exception:
+        ndb.delete_multi(ndb.Query(ancestor=newKey).fetch(keys_only=True) + [moveKey])
+        cancel_migration(old.key)
+        raise
+
+    # The new group is the one in use once the old one is gone; anything
+    # left after that is unreachable. The new group builds its matching
+    # again when it's next needed.
+    old.key.delete()
+    ndb.delete_multi([reg.key for reg in regs] + [w.key for w in oldWishLists] + [pair.key for pair in oldPairs]
+        + [SantaGroupMatching.keyFor(old.key), SantaGroupCounts.keyFor(old.key)])
+    move_memberships(people.values(), old.key, group)
+    return True
+
+def copy_group(old, newKey):
+    """ Copies a frozen group under newKey and checks the copy. Returns what
+    was copied: the registrations, their people, pairings and wish lists,
+    and the new group. """
+    regs = registrationsQuery(old.key).fetch()
+    people = getEntityMap([reg.person for reg in regs])
+    oldPairs = SantaPairing.query(ancestor=old.key).fetch()
+    oldWishLists = [w for w in ndb.get_multi([SantaWishList.keyFor(reg.key) for reg in regs]) if w]
+
+    newRegKeys = {}
+    newRegs = []
+    for reg in regs:
+        values = reg.to_dict()
+        values["group"] = newKey
+        newReg = SantaRegistration(key=SantaRegistration.keyFor(newKey, people[reg.person].userId), **values)
+        newRegKeys[reg.key] = newReg.key
+        newRegs.append(newReg)
+
+    newWishLists = [SantaWishList(key=SantaWishList.keyFor(newRegKeys[w.key.parent()]), advice=w.advice)
+        for w in oldWishLists]
+
+    newPairs = []
+    for pair in oldPairs:
+        values = pair.to_dict()
+        values["source"] = newRegKeys[pair.source]
+        values["target"] = newRegKeys[pair.target]
+        newPairs.append(SantaPairing(key=ndb.Key(SantaPairing, pair.key.id(), parent=newKey), **values))
+
+    values = old.to_dict()
+    values["pairs"] = [ndb.Key(SantaPairing, k.id(), parent=newKey) for k in old.pairs]
+    values["migrating"] = None
+    group = SantaGroup(key=newKey, **values)
+    counts = SantaGroupCounts(key=SantaGroupCounts.keyFor(newKey), members=len(regs),
+        completed=len([reg for reg in regs if reg.completionDate]))
+    ndb.put_multi(newRegs + newWishLists + newPairs + [group, counts])
+
+    # Check the copy against the original as it is now
+    copiedRegs = SantaRegistration.query(ancestor=newKey).fetch(keys_only=True)
+    copiedPairs = SantaPairing.query(ancestor=newKey).fetch(keys_only=True)
+    currentRegs = registrationsQuery(old.key).fetch(use_cache=False)
+    if (sorted(copiedRegs) != sorted(newRegKeys.values()) or len(copiedPairs) != len(oldPairs)
+            or not sameRegistrations(currentRegs, newRegKeys)):
+        raise Exception("Copy of group {} didn't check out".format(old.name))
+    return regs, people, oldPairs, oldWishLists, group
+
+@ndb.transactional_tasklet
+def _moveMembership(key, oldGroupKey, group):
+    memberships = yield key.get_async()
+    if memberships is None:
+        return
+    completed = False
+    for summary in memberships.groups:
+        if summary.group == oldGroupKey:
+            completed = summary.completed
+    memberships.groups = [summary for summary in memberships.groups if summary.group != oldGroupKey]
+    memberships.setGroup(group, completed)
+    yield memberships.put_async()
+
+def move_memberships(people, oldGroupKey, group):
+    """ Points home page summaries at a migrated group's new key """
+    futures = [_moveMembership(SantaMemberships.keyFor(person.userId), oldGroupKey, group) for person in people]
+    for future in futures:
+        future.get_result()
+
+@ndb.transactional
+def _moveWishList(regKey):
+    """ Moves one registration's shopping advice into its SantaWishList.
+    Re-read here, so a list submitted meanwhile isn't undone; if it's
+    already there, the old advice is just dropped. """
+    reg = regKey.get()
+    if reg is None or reg.shoppingAdvice is None:
+        return False
+    changed = [reg]
+    wishKey = SantaWishList.keyFor(regKey)
+    if wishKey.get() is None:
+        changed.append(SantaWishList(key=wishKey, advice=reg.shoppingAdvice))
+    reg.shoppingAdvice = None
+    ndb.put_multi(changed)
+    return True
+
+@app.route('/admin/migrate/wishlists')
+def admin_migrate_wishlists():
+    enqueueTask('migrate_wishlists_task')
+    return "Started"
+
+@app.route('/admin/task/migrate_wishlists', methods=['POST'])
+def migrate_wishlists_task():
+    """ Moves shopping advice off registrations into SantaWishLists, a page
+    at a time """
+    cursor = Cursor(urlsafe=request.form['cursor']) if request.form.get('cursor') else None
+    regs, nextCursor, more = SantaRegistration.query().fetch_page(MIGRATION_PAGE_SIZE, start_cursor=cursor)
+
+    moved = [reg for reg in regs if reg.shoppingAdvice is not None and _moveWishList(reg.key)]
+    logging.info("Moved {} wish lists".format(len(moved)))
+
+    if more:
+        enqueueTask('migrate_wishlists_task', cursor=nextCursor.urlsafe())
+    return "OK"
 
-    return "OK {}".format(countReg)
+@ndb.transactional(xg=True)
+def _repointRegistration(regKey, oldKey, newKey):
+    """ Points one registration, and the pairing keyed by its person, at
+    the person's new key. Re-read here so concurrent changes survive. """
+    reg = regKey.get()
+    if reg is None:
+        return
+    changed = [reg]
+    deleted = []
+    if reg.person == oldKey:
+        reg.person = newKey
+        # Their pairing is keyed by their person id too
+        pair = SantaPairing.keyFor(reg.group, oldKey).get()
+        if pair:
+            group = reg.group.get()
+            moved = SantaPairing(key=SantaPairing.keyFor(reg.group, newKey), **pair.to_dict())
+            group.pairs = [moved.key if k == pair.key else k for k in group.pairs]
+            changed = changed + [group, moved]
+            deleted.append(pair.key)
+    reg.prohibitedPeople = [newKey if k == oldKey else k for k in reg.prohibitedPeople]
+
+    # Matchings name people by key; drop it so it's built again
+    deleted.append(SantaGroupMatching.keyFor(reg.group))
+    ndb.put_multi(changed)
+    ndb.delete_multi(deleted)
+
+@ndb.transactional
+def _repointReferences(key, oldKey, newKey):
+    """ Points a group's owner or a pairing's target at the new key """
+    entity = key.get()
+    if entity is None:
+        return
+    for name in ("owner", "targetPerson"):
+        if getattr(entity, name, None) == oldKey:
+            setattr(entity, name, newKey)
+    entity.put()
+
+def migrate_person(old):
+    """ Copies one person to their new key and points everything that
+    referred to the old key at it, an entity at a time. The old person is
+    left for migrate_people_task to delete. Returns whether anything
+    referred to it. """
+    newKey = SantaPerson.keyFor(old.userId)
+    # Later passes mustn't undo changes made to the copy since
+    if newKey.get() is None:
+        SantaPerson(key=newKey, **old.to_dict()).put()
+
+    regKeys = set(SantaRegistration.query(SantaRegistration.person == old.key).fetch(keys_only=True)
+        + SantaRegistration.query(SantaRegistration.prohibitedPeople == old.key).fetch(keys_only=True))
+    for regKey in regKeys:
+        _repointRegistration(regKey, old.key, newKey)
+
+    otherKeys = (SantaGroup.query(SantaGroup.owner == old.key).fetch(keys_only=True)
+        + SantaPairing.query(SantaPairing.targetPerson == old.key).fetch(keys_only=True))
+    for key in otherKeys:
+        _repointReferences(key, old.key, newKey)
+
+    return len(regKeys) + len(otherKeys) > 0
+
+#
+# Bulk data. Counts, matchings and memberships aren't exported; they're
+# rebuilt from these when needed, or by /admin/migrate/memberships.
+#
+def exportModels():
+    # People and groups first, so an import never stores a reference
+    # before what it refers to
+    return [SantaPerson, SantaGroup, SantaRegistration, SantaWishList, SantaPairing]
+
+@app.route('/admin/export')
+def admin_export():
+    """ One page of the groups, people, registrations, wish lists and
+    pairings, as JSON lines. The X-Next-Page header is where the next page
+    is, until there are none left. ?kinds=SantaGroup,SantaPerson picks
+    some. """
+    import datastore_jsonl
+    models = exportModels()
+    if request.args.get('kinds'):
+        kinds = request.args['kinds'].split(",")
+        if [kind for kind in kinds if kind not in [m._get_kind() for m in models]]:
+            abort(404)
+        models = [m for m in models if m._get_kind() in kinds]
+
+    kinds = [m._get_kind() for m in models]
+    kind = request.args.get('kind', kinds[0])
+    if kind not in kinds:
+        abort(404)
+    model = models[kinds.index(kind)]
+    cursor = Cursor(urlsafe=request.args['cursor']) if request.args.get('cursor') else None
+    lines, nextCursor, more = datastore_jsonl.dumpPage(model, EXPORT_PAGE_SIZE, cursor)
+
+    response = Response("".join(lines), mimetype="application/x-ndjson")
+    if more and nextCursor:
+        nextPage = url_for('admin_export', kinds=request.args.get('kinds'), kind=kind, cursor=nextCursor.urlsafe())
+    elif kind != kinds[-1]:
+        nextPage = url_for('admin_export', kinds=request.args.get('kinds'), kind=kinds[kinds.index(kind) + 1])
+    else:
+        nextPage = None
+    if nextPage:
+        response.headers["X-Next-Page"] = nextPage
+    return response
+
+@app.route('/admin/import', methods=['POST'])
+def admin_import():
+    """ Loads the body of the request, up to IMPORT_REQUEST_LINES lines as
+    written by /admin/export. Send it as application/x-ndjson so it isn't
+    parsed as a form first. Entities keep their keys, so a part that failed
+    can just be sent again. """
+    import datastore_jsonl
+    models = dict((m._get_kind(), m) for m in exportModels())
+    lines = request.get_data().splitlines()
+    if len(lines) > IMPORT_REQUEST_LINES:
+        abort(413)
+    try:
+        counts = datastore_jsonl.loadLines(lines, models, IMPORT_BATCH_SIZE)
+    except (KeyError, ValueError) as e:
+        logging.warning("Import stopped: {}".format(e))
+        abort(400)
+    logging.info("Imported {}".format(counts))
+    return jsonify(**counts)
+
+@app.route('/_ah/warmup')
+def warmup():
+    """ App Engine sends this to a new instance before any users: compile
+    every template and load what the first requests will need """
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    emailRenderer()
+    # Modules the first requests would otherwise import themselves
+    for module in ("outbox", "people_matcher"):
+        importlib.import_module(module)
+    return ""
 
 @app.errorhandler(404)
 def error_404(e):
@@ -0,0 +1,101 @@
+"""
+Outbound mail for SantaBot.
+
+Handlers don't send mail themselves; they store OutboundMail entities and
+queue a task for them. The task calls deliver(), which sends a batch at a
+time through a transport and records how each message went. How fast and
+how many batches run at once is set on the "mail" queue in queue.yaml, and
+the queue's retry parameters handle the backoff.
+"""
+
+import datetime
+import logging
+import smtplib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from google.appengine.api import mail
+from google.appengine.ext import ndb
+
+# OutboundMail.status values
+MAIL_QUEUED = "queued"
+MAIL_SENT = "sent"
+MAIL_FAILED = "failed"
+
+# Give up on a message after this many tries
+MAX_ATTEMPTS = 5
+
+class OutboundMail(ndb.Model):
+    """ An email waiting to go out, or a record of one that did """
+    sender = ndb.StringProperty(indexed=False)
+    to = ndb.StringProperty(indexed=False)
+    subject = ndb.StringProperty(indexed=False)
+    body = ndb.TextProperty()
+    html = ndb.TextProperty()
+    status = ndb.StringProperty(default=MAIL_QUEUED)
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
+    lastError = ndb.StringProperty(indexed=False)
+    createDate = ndb.DateTimeProperty(auto_now_add=True)
+    sentDate = ndb.DateTimeProperty()
+
+#
+# Transports
+#
+class AppEngineTransport(object):
+    """ Sends through the App Engine mail API """
+    def send(self, message):
+        email = mail.EmailMessage(sender=message.sender, to=message.to, subject=message.subject,
+            body=message.body, html=message.html)
+        email.send()
+
+class SmtpTransport(object):
+    """ Sends to an SMTP server, such as a local sink for testing:
+    python -m smtpd -n -c DebuggingServer localhost:1025 """
+    def __init__(self, host="localhost", port=1025):
+        self.host = host
+        self.port = port
+
+    def send(self, message):
+        email = MIMEMultipart("alternative")
+        email["From"] = message.sender
+        email["To"] = message.to
+        email["Subject"] = message.subject
+        email.attach(MIMEText(message.body, "plain", "utf-8"))
+        email.attach(MIMEText(message.html, "html", "utf-8"))
+
+        server = smtplib.SMTP(self.host, self.port)
+        try:
+            server.sendmail(message.sender, [message.to], email.as_string())
+        finally:
+            server.quit()
+
+#
+# Delivery
+#
+def deliver(keys, transport):
+    """ Sends every message in keys that hasn't gone out yet, all at once.
+    Returns False if any of them should be tried again later. """
+    messages = [m for m in ndb.get_multi(keys) if m and m.status == MAIL_QUEUED]
+
+    def sendOne(message):
+        message.attempts = message.attempts + 1
+        try:
+            transport.send(message)
+            message.status = MAIL_SENT
+            message.sentDate = datetime.datetime.now()
+            message.lastError = None
+        except Exception as e:
+            logging.warning("Mail to {} failed on try {}: {}".format(message.to, message.attempts, e))
+            message.lastError = str(e)
+            if message.attempts >= MAX_ATTEMPTS:
+                message.status = MAIL_FAILED
+
+    threads = [threading.Thread(target=sendOne, args=(m,)) for m in messages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ndb.put_multi(messages)
+    return all(m.status != MAIL_QUEUED for m in messages)
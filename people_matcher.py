@@ -1,9 +1,26 @@
-import random, logging, itertools
+import random, logging, itertools, math
 
 class PeopleMatcher(object):
-  def __init__(self):
+  # The original engine: shuffle everything and throw it away on the first
+  # bad pairing, up to 99 times.
+  ENGINE_SHUFFLE = "shuffle"
+  # Bipartite matching over the allowed-edge graph. Only fails when it can
+  # prove there is no answer.
+  ENGINE_MATCHING = "matching"
+
+  # How many plain shuffles the matching engine tries before it starts
+  # repairing one. A clean shuffle is an exactly uniform answer.
+  REJECTION_TRIES = 10
+
+  def __init__(self, engine=ENGINE_SHUFFLE):
     self.data=[]
     self.honoredProhibited = 0
+    self.engine = engine
+    # An assignment to repair instead of a shuffle, see setWarmStart
+    self.warmStart = None
+    # Statistics about the last execute()
+    self.tries = 0
+    self.hallViolation = None
 
   def __repr__(self):
     return str(self.data)
@@ -11,6 +28,17 @@ class PeopleMatcher(object):
   def setHonoredProhibited(self, val):
     self.honoredProhibited = int(val)
 
+  def setEngine(self, engine):
+    if engine not in (self.ENGINE_SHUFFLE, self.ENGINE_MATCHING):
+      raise Exception("Unknown engine", engine)
+    self.engine = engine
+
+  def setWarmStart(self, assignment):
+    """ assignment maps each person to who they give to, like one kept by
+    IncrementalMatcher. When no plain shuffle works, the matching engine
+    repairs this instead of the last shuffle. """
+    self.warmStart = assignment
+
   def addPerson(self, person, prohibited=[]):
     for o in prohibited:
       if person == o:
@@ -23,8 +51,16 @@ class PeopleMatcher(object):
     self.data.append({"id":person, "prohibited":prohibited})
 
   def execute(self):
+    self.tries = 0
+    self.hallViolation = None
+
+    if self.engine == self.ENGINE_MATCHING:
+      return self._executeMatching()
+    return self._executeShuffle()
+
+  def _executeShuffle(self):
     sources = list(self.data)
-    
+
     stillTrying = True
     tryNumber = 0
     graphSegments = None
@@ -60,8 +96,264 @@ class PeopleMatcher(object):
           "target": targets[i]["id"]
         })
 
+    self.tries = tryNumber
+
     if stillTrying:
       # We couldn't solve in 99 tries
       return None
 
-    return graphSegments
\ No newline at end of file
+    return graphSegments
+
+  def _forbiddenSets(self):
+    # Everyone is allowed to give to everyone, except themselves and the
+    # honored part of their no-list. Keeping only the forbidden edges keeps
+    # this linear in the group size.
+    index = {}
+    for i, entry in enumerate(self.data):
+      index[entry["id"]] = i
+
+    forbidden = []
+    for i, entry in enumerate(self.data):
+      bad = set([i])
+      for o in entry["prohibited"][:self.honoredProhibited]:
+        if o in index:
+          bad.add(index[o])
+      forbidden.append(bad)
+    return forbidden
+
+  def _executeMatching(self):
+    n = len(self.data)
+    forbidden = self._forbiddenSets()
+
+    # Plain rejection sampling first; when it works the result is uniform.
+    matchS = list(range(n))
+    clean = False
+    while not clean and self.tries < self.REJECTION_TRIES:
+      self.tries = self.tries + 1
+      random.shuffle(matchS)
+      clean = True
+      for s in range(n):
+        if matchS[s] in forbidden[s]:
+          clean = False
+          break
+
+    if not clean:
+      if self.warmStart is not None:
+        matchS = self._fromAssignment(self.warmStart)
+
+      # Keep the good part of the last shuffle and augment the rest
+      matchT = [-1] * n
+      free = []
+      for s in range(n):
+        if matchS[s] == -1 or matchS[s] in forbidden[s]:
+          matchS[s] = -1
+          free.append(s)
+        else:
+          matchT[matchS[s]] = s
+
+      random.shuffle(free)
+      for s in free:
+        violation = self._augment(s, matchS, matchT, forbidden)
+        if violation:
+          sources, targets = violation
+          self.hallViolation = {
+            "sources": [self.data[i]["id"] for i in sources],
+            "targets": [self.data[i]["id"] for i in targets],
+          }
+          logging.info("No assignment possible honoring {} prohibitions: {} people can only give to {}".format(
+            self.honoredProhibited, len(sources), len(targets)))
+          return None
+
+      self._mix(matchS, forbidden)
+
+    return [{"source": self.data[s]["id"], "target": self.data[matchS[s]]["id"]} for s in range(n)]
+
+  def _fromAssignment(self, assignment):
+    # Pairs for people who left or who'd give to someone twice are dropped
+    # and get augmented like any other
+    index = {}
+    for i, entry in enumerate(self.data):
+      index[entry["id"]] = i
+
+    matchS = [-1] * len(self.data)
+    taken = set()
+    for s, entry in enumerate(self.data):
+      t = index.get(assignment.get(entry["id"]), -1)
+      if t != -1 and t not in taken:
+        matchS[s] = t
+        taken.add(t)
+    return matchS
+
+  @staticmethod
+  def _augment(start, matchS, matchT, forbidden):
+    # Breadth-first search for an augmenting path from a free source. The
+    # graph is nearly complete, so rather than walking adjacency lists we
+    # keep the set of unreached targets and take everything a source isn't
+    # forbidden from; each target is reached once, so this is O(n).
+    unreached = set(range(len(matchT)))
+    via = {}
+    queue = [start]
+    reachedSources = [start]
+
+    while queue:
+      s = queue.pop(0)
+      hits = [t for t in unreached if t not in forbidden[s]]
+      unreached.intersection_update(forbidden[s])
+      random.shuffle(hits)
+
+      for t in hits:
+        via[t] = s
+        if matchT[t] == -1:
+          # Flip the path back to the start
+          while t != -1:
+            s = via[t]
+            nextT = matchS[s]
+            matchS[s] = t
+            matchT[t] = s
+            t = nextT
+          return None
+
+        queue.append(matchT[t])
+        reachedSources.append(matchT[t])
+
+    # Every target these sources may give to is already taken by another one
+    # of them, and there's one more source than targets: Hall's condition
+    # fails, so no complete assignment exists.
+    return (reachedSources, list(via.keys()))
+
+  def _mix(self, matchS, forbidden):
+    # The repaired assignment leans toward the shuffle it came from. Random
+    # swaps that keep every pair allowed walk it back towards uniform; about
+    # n log n of them is enough for a random-transposition walk to mix.
+    n = len(matchS)
+    if n < 3:
+      return
+    for step in range(int(n * math.ceil(math.log(n)))):
+      i = random.randrange(n)
+      j = random.randrange(n)
+      if matchS[j] not in forbidden[i] and matchS[i] not in forbidden[j]:
+        matchS[i], matchS[j] = matchS[j], matchS[i]
+
+
+class IncrementalMatcher(object):
+  """ Keeps one assignment that honors every no-list while a group fills
+  up. Each join or no-list only repairs the pairs it breaks, usually with a
+  single swap, so we know whether the group can be solved long before it's
+  run. state() is plain JSON for storing between requests. """
+
+  # Random swaps to try before searching for an augmenting path
+  SWAP_TRIES = 20
+
+  def __init__(self, state=None):
+    state = state or {}
+    self.ids = list(state.get("ids", []))
+    self.prohibited = [list(p) for p in state.get("prohibited", [])]
+    self.matchS = list(state.get("match", []))
+    self.hallViolation = state.get("hallViolation")
+
+    self.index = {}
+    for i, person in enumerate(self.ids):
+      self.index[person] = i
+    # Sources whose no-list names someone who hasn't joined yet
+    self.waiting = {}
+    self.forbidden = [self._forbiddenFor(s) for s in range(len(self.ids))]
+    self.matchT = [-1] * len(self.ids)
+    for s, t in enumerate(self.matchS):
+      if t != -1:
+        self.matchT[t] = s
+
+  def state(self):
+    return {"ids": self.ids, "prohibited": self.prohibited, "match": self.matchS,
+      "hallViolation": self.hallViolation}
+
+  @property
+  def feasible(self):
+    return -1 not in self.matchS
+
+  def assignment(self):
+    """ Who each person gives to, or None while the group can't be solved """
+    if not self.feasible:
+      return None
+    return dict((self.ids[s], self.ids[t]) for s, t in enumerate(self.matchS))
+
+  def addPerson(self, person):
+    if person in self.index:
+      return
+    i = len(self.ids)
+    self.ids.append(person)
+    self.index[person] = i
+    self.prohibited.append([])
+    self.forbidden.append(set([i]))
+    for s in self.waiting.pop(person, []):
+      self.forbidden[s].add(i)
+    self.matchS.append(-1)
+    self.matchT.append(-1)
+    self._repair()
+
+  def setProhibited(self, person, prohibited):
+    s = self.index[person]
+    for o in self.prohibited[s]:
+      if o in self.waiting and s in self.waiting[o]:
+        self.waiting[o].remove(s)
+    self.prohibited[s] = list(prohibited)
+    self.forbidden[s] = self._forbiddenFor(s)
+    if self.matchS[s] in self.forbidden[s]:
+      self._release(s)
+    self._repair()
+
+  def _forbiddenFor(self, s):
+    bad = set([s])
+    for o in self.prohibited[s]:
+      if o in self.index:
+        bad.add(self.index[o])
+      else:
+        self.waiting.setdefault(o, []).append(s)
+    return bad
+
+  def _release(self, s):
+    self.matchT[self.matchS[s]] = -1
+    self.matchS[s] = -1
+
+  def _repair(self):
+    # Only a group that couldn't be solved before has more than a pair or
+    # two to place here
+    freeS = [s for s, t in enumerate(self.matchS) if t == -1]
+    freeT = [t for t, s in enumerate(self.matchT) if s == -1]
+    self.hallViolation = None
+
+    for s in freeS:
+      if self._swap(s, freeT[-1]):
+        freeT.pop()
+        continue
+
+      violation = PeopleMatcher._augment(s, self.matchS, self.matchT, self.forbidden)
+      if violation:
+        sources, targets = violation
+        self.hallViolation = {
+          "sources": [self.ids[i] for i in sources],
+          "targets": [self.ids[i] for i in targets],
+        }
+      else:
+        freeT = [t for t in freeT if self.matchT[t] == -1]
+
+  def _swap(self, s, t):
+    # The graph is nearly complete, so giving s the free target directly, or
+    # trading with a random giver, almost always works
+    if t not in self.forbidden[s]:
+      self._pair(s, t)
+      return True
+
+    n = len(self.ids)
+    for attempt in range(self.SWAP_TRIES):
+      other = random.randrange(n)
+      otherT = self.matchS[other]
+      if otherT == -1 or otherT in self.forbidden[s] or t in self.forbidden[other]:
+        continue
+      self._pair(s, otherT)
+      self._pair(other, t)
+      return True
+    return False
+
+  def _pair(self, s, t):
+    self.matchS[s] = t
+    self.matchT[t] = s
@@ -0,0 +1,111 @@
+"""
+Solves many groups at once with PeopleMatcher, one process per core.
+
+Needs only plain Python, no App Engine or Flask:
+
+    python people_matcher_batch.py groups.jsonl -o results.jsonl
+    python people_matcher_batch.py --engine shuffle --processes 4 < groups.jsonl
+
+Each input line is a group:
+
+    {"id": "office", "members": [{"id": "ann", "prohibited": ["bob"]}, {"id": "bob"}, ...]}
+
+Each output line is that group's result, in the order they finish:
+
+    {"line": 1, "id": "office", "pairs": [{"source": "ann", "target": "cy"}, ...],
+     "honored": 2, "tries": 1, "ms": 0.4}
+
+Like a group run, no-lists are relaxed from two names down to none until
+there's an answer. "pairs" is null when even that fails, and "error" says
+why a line couldn't be solved at all.
+"""
+
+import argparse, json, logging, multiprocessing, random, sys, time
+
+from people_matcher import PeopleMatcher
+
+def startWorker():
+    # PeopleMatcher logs every person it's given
+    logging.disable(logging.CRITICAL)
+    # Forked workers would otherwise all shuffle the same way
+    random.seed()
+
+def solveGroup(job):
+    """ Solves one input line. Runs in a worker process. """
+    lineNumber, line, engine, seed = job
+    result = {"line": lineNumber}
+    start = time.time()
+    try:
+        group = json.loads(line)
+        result["id"] = group.get("id", lineNumber)
+        if seed is not None:
+            # Same answer for a group however the work gets split up
+            random.seed("{}:{}".format(seed, result["id"]))
+
+        pm = PeopleMatcher(engine=engine)
+        for member in group["members"]:
+            pm.addPerson(member["id"], prohibited=list(member.get("prohibited", [])))
+
+        result["pairs"] = None
+        result["tries"] = 0
+        for honored in range(group.get("honored", 2), -1, -1):
+            pm.setHonoredProhibited(honored)
+            graphSegments = pm.execute()
+            result["tries"] = result["tries"] + pm.tries
+            if graphSegments is not None:
+                result["pairs"] = graphSegments
+                result["honored"] = honored
+                break
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["ms"] = round((time.time() - start) * 1000.0, 3)
+    return result
+
+def readJobs(infile, engine, seed):
+    for lineNumber, line in enumerate(infile, 1):
+        if line.strip():
+            yield (lineNumber, line, engine, seed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve groups from a JSONL file in parallel")
+    parser.add_argument("input", nargs="?", default="-", help="JSONL groups, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL results, - for stdout")
+    parser.add_argument("--engine", default=PeopleMatcher.ENGINE_MATCHING,
+        choices=[PeopleMatcher.ENGINE_SHUFFLE, PeopleMatcher.ENGINE_MATCHING])
+    parser.add_argument("--processes", type=int, default=None, help="defaults to one per CPU")
+    parser.add_argument("--chunksize", type=int, default=16, help="groups handed to a worker at a time")
+    parser.add_argument("--seed", default=None, help="makes every group's answer repeatable")
+    args = parser.parse_args()
+
+    infile = sys.stdin if args.input == "-" else open(args.input)
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w")
+
+    pool = multiprocessing.Pool(args.processes, initializer=startWorker)
+    start = time.time()
+    solved = 0
+    unsolved = 0
+    errors = 0
+    try:
+        # Results go out as each group finishes, not after the whole file
+        for result in pool.imap_unordered(solveGroup, readJobs(infile, args.engine, args.seed), args.chunksize):
+            if "error" in result:
+                errors = errors + 1
+            elif result["pairs"] is None:
+                unsolved = unsolved + 1
+            else:
+                solved = solved + 1
+            outfile.write(json.dumps(result) + "\n")
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    sys.stderr.write("{} solved, {} unsolvable, {} errors in {:.1f}s\n".format(
+        solved, unsolved, errors, time.time() - start))
+
+if __name__ == "__main__":
+    main()
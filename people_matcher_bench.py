@@ -0,0 +1,187 @@
+"""
+Benchmarks PeopleMatcher engines on synthetic groups.
+
+Run it with plain Python, no App Engine needed:
+
+    python people_matcher_bench.py
+    python people_matcher_bench.py --sizes 3,100,10000 --runs 20 --engines matching
+
+For every engine, layout and size it reports solve latency percentiles, the
+number of shuffles tried, how often the no-lists had to be relaxed and how
+often there was no answer at all. The fairness section samples a small group
+many times and runs a chi-square test of the assignments it got against the
+uniform distribution over every valid assignment.
+"""
+
+import argparse, itertools, logging, math, random, time
+
+from people_matcher import PeopleMatcher
+
+ENGINES = [PeopleMatcher.ENGINE_SHUFFLE, PeopleMatcher.ENGINE_MATCHING]
+
+#
+# Synthetic groups. Each layout returns a list of (person, prohibited) tuples.
+#
+def layoutRandom(n):
+    """ Everyone avoids 0-2 random other members """
+    group = []
+    for i in range(n):
+        others = [o for o in random.sample(range(n), min(n, 3)) if o != i]
+        group.append((i, others[:random.randint(0, 2)]))
+    return group
+
+def layoutClustered(n):
+    """ Members come in households of three who all avoid each other """
+    group = []
+    for i in range(n):
+        base = i - i % 3
+        group.append((i, [o for o in range(base, min(base + 3, n)) if o != i]))
+    return group
+
+def layoutStar(n):
+    """ Everyone avoids the same couple of people """
+    hubs = [0, 1]
+    group = []
+    for i in range(n):
+        group.append((i, [h for h in hubs if h != i and h < n]))
+    return group
+
+LAYOUTS = {
+    "random": layoutRandom,
+    "clustered": layoutClustered,
+    "star": layoutStar,
+}
+
+#
+# Solving, the same way group_run does it
+#
+def solve(engine, group):
+    pm = PeopleMatcher(engine=engine)
+    for person, prohibited in group:
+        pm.addPerson(person, prohibited=list(prohibited))
+
+    tries = 0
+    for honored in range(2, -1, -1):
+        pm.setHonoredProhibited(honored)
+        graphSegments = pm.execute()
+        tries = tries + pm.tries
+        if graphSegments is not None:
+            return graphSegments, tries, 2 - honored
+    return None, tries, 3
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def benchmark(engines, layouts, sizes, runs):
+    print("{:<9} {:<10} {:>6} {:>9} {:>9} {:>9} {:>8} {:>10} {:>8}".format(
+        "engine", "layout", "n", "p50 ms", "p90 ms", "p99 ms", "tries", "fallbacks", "failed"))
+
+    for engine in engines:
+        for layoutName in layouts:
+            for n in sizes:
+                latencies = []
+                tries = 0
+                fallbacks = 0
+                failures = 0
+
+                for run in range(runs):
+                    group = LAYOUTS[layoutName](n)
+                    start = time.time()
+                    graphSegments, runTries, relaxed = solve(engine, group)
+                    latencies.append((time.time() - start) * 1000.0)
+                    tries = tries + runTries
+                    if graphSegments is None:
+                        failures = failures + 1
+                    else:
+                        fallbacks = fallbacks + relaxed
+
+                print("{:<9} {:<10} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f} {:>10.2f} {:>7.0f}%".format(
+                    engine, layoutName, n,
+                    percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+                    float(tries) / runs, float(fallbacks) / runs, 100.0 * failures / runs))
+
+#
+# Fairness
+#
+def validAssignments(group, honored):
+    people = [person for person, prohibited in group]
+    forbidden = dict((person, set(prohibited[:honored])) for person, prohibited in group)
+
+    valid = []
+    for targets in itertools.permutations(people):
+        if all(t != s and t not in forbidden[s] for s, t in zip(people, targets)):
+            valid.append(targets)
+    return valid
+
+def chiSquarePValue(statistic, dof):
+    """ Upper tail of the chi-square distribution, Wilson-Hilferty approximation """
+    if dof <= 0:
+        return 1.0
+    z = ((statistic / dof) ** (1.0 / 3) - (1 - 2.0 / (9 * dof))) / math.sqrt(2.0 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def fairness(engines, size, trials):
+    group = layoutRandom(size)
+    honored = 2
+    valid = validAssignments(group, honored)
+    while not valid and honored > 0:
+        honored = honored - 1
+        valid = validAssignments(group, honored)
+
+    print("")
+    print("Fairness: {} members, {} valid assignments, {} samples".format(size, len(valid), trials))
+    print("{:<9} {:>12} {:>6} {:>9} {:>8}".format("engine", "chi-square", "dof", "p-value", "unseen"))
+
+    for engine in engines:
+        counts = dict((targets, 0) for targets in valid)
+        for trial in range(trials):
+            pm = PeopleMatcher(engine=engine)
+            for person, prohibited in group:
+                pm.addPerson(person, prohibited=list(prohibited))
+            pm.setHonoredProhibited(honored)
+            graphSegments = pm.execute()
+            if graphSegments is None:
+                continue
+            assignment = dict((s["source"], s["target"]) for s in graphSegments)
+            counts[tuple(assignment[person] for person, prohibited in group)] += 1
+
+        samples = sum(counts.values())
+        if not samples:
+            print("{:<9} {:>12}".format(engine, "no answers"))
+            continue
+        expected = float(samples) / len(valid)
+        statistic = sum((c - expected) ** 2 / expected for c in counts.values())
+        dof = len(valid) - 1
+        unseen = len([c for c in counts.values() if c == 0])
+        print("{:<9} {:>12.1f} {:>6} {:>9.4f} {:>8}".format(
+            engine, statistic, dof, chiSquarePValue(statistic, dof), unseen))
+
+def parseList(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PeopleMatcher engines on synthetic groups")
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    parser.add_argument("--layouts", default="random,clustered,star")
+    parser.add_argument("--sizes", default="3,10,100,1000,10000")
+    parser.add_argument("--runs", type=int, default=10, help="groups solved per engine, layout and size")
+    parser.add_argument("--fairness-size", type=int, default=6, help="members in the fairness group (keep it small)")
+    parser.add_argument("--fairness-trials", type=int, default=20000, help="0 skips the fairness check")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    # PeopleMatcher logs every person it's given
+    logging.disable(logging.CRITICAL)
+    random.seed(args.seed)
+
+    engines = parseList(args.engines)
+    benchmark(engines, parseList(args.layouts), [int(n) for n in parseList(args.sizes)], args.runs)
+    if args.fairness_trials:
+        fairness(engines, args.fairness_size, args.fairness_trials)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Counts what each request costs, by endpoint.
+
+install(app) hooks the App Engine API proxy, so every datastore, memcache
+and mail RPC a request makes is counted against it, including the ones
+templates make while they render. Wrap other work to time in timed().
+
+Each request logs one "request_metrics" line of JSON, and a warning with
+its RPC breakdown when it takes longer than app.config['SLOW_REQUEST_MS'].
+The last WINDOW_MINUTES of requests are kept per endpoint, with a latency
+histogram, for /admin/metrics. Those numbers are for this instance only;
+the log lines cover them all.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import request
+
+# Upper bounds of the latency histogram buckets, in ms; the last is open
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# How far back /admin/metrics looks
+WINDOW_MINUTES = 10
+
+# Short names for the RPCs worth telling apart
+RPC_NAMES = {
+    ("datastore_v3", "Get"): "get",
+    ("datastore_v3", "Put"): "put",
+    ("datastore_v3", "Delete"): "delete",
+    ("datastore_v3", "RunQuery"): "query",
+    ("datastore_v3", "Next"): "query_next",
+    ("datastore_v3", "Commit"): "commit",
+    ("mail", "Send"): "mail",
+}
+
+class RequestStats(object):
+    """ What one request has done so far """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.time()
+        self.status = None
+        self.rpcs = collections.Counter()
+        self.renderRpcs = collections.Counter()
+        self.timings = collections.Counter()
+        self.phase = None
+
+    def record(self, service, call):
+        name = RPC_NAMES.get((service, call)) or "{}.{}".format(service, call)
+        self.rpcs[name] += 1
+        if self.phase == "render":
+            self.renderRpcs[name] += 1
+
+    def summary(self, elapsed):
+        return {"endpoint": self.endpoint, "status": self.status, "ms": round(elapsed, 1),
+            "rpcs": dict(self.rpcs), "renderRpcs": dict(self.renderRpcs),
+            "timings": dict((k, round(v, 1)) for k, v in self.timings.items())}
+
+class EndpointStats(object):
+    """ Totals for one endpoint over one minute """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.totalMs = 0.0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.rpcs = collections.Counter()
+        self.timings = collections.Counter()
+
+    def add(self, stats, elapsed):
+        self.requests += 1
+        if stats.status is None or stats.status >= 500:
+            self.errors += 1
+        self.totalMs += elapsed
+        self.latency[bucketFor(elapsed)] += 1
+        self.rpcs.update(stats.rpcs)
+        self.timings.update(stats.timings)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.totalMs += other.totalMs
+        self.latency = [a + b for a, b in zip(self.latency, other.latency)]
+        self.rpcs.update(other.rpcs)
+        self.timings.update(other.timings)
+
+    def percentile(self, pct):
+        """ The upper bound of the bucket the pct'th request fell in """
+        rank = pct / 100.0 * self.requests
+        seen = 0
+        for i, count in enumerate(self.latency):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+        return None
+
+    def perRequest(self, counter):
+        return dict((k, float(v) / self.requests) for k, v in counter.items())
+
+def bucketFor(elapsed):
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if elapsed <= bound:
+            return i
+    return len(LATENCY_BUCKETS)
+
+_lock = threading.Lock()
+# Requests in flight, by request id, innermost last. Outbound mail is sent
+# from worker threads, so a thread local wouldn't see all of a request's
+# RPCs. Tasks run inline are requests inside the request that queued them,
+# with the same id; each counts its own RPCs until it ends.
+_active = {}
+# (minute, {endpoint: EndpointStats}), oldest first
+_minutes = collections.deque(maxlen=WINDOW_MINUTES)
+# Called with every finished request's summary, see addListener
+_listeners = []
+
+def _requestId():
+    return os.environ.get("REQUEST_LOG_ID") or threading.current_thread().ident
+
+def current():
+    """ The running request's stats, or None outside a request """
+    stack = _active.get(_requestId())
+    return stack[-1] if stack else None
+
+class timed(object):
+    """ Adds the time spent in a with block to the request's timings under
+    name. RPCs made meanwhile are also counted as that phase's. """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.stats = current()
+        self.start = time.time()
+        if self.stats:
+            self.outer = self.stats.phase
+            self.stats.phase = self.name
+
+    def __exit__(self, *exc):
+        if self.stats:
+            self.stats.timings[self.name] += (time.time() - self.start) * 1000.0
+            self.stats.phase = self.outer
+
+def _countRpc(service, call, request, response):
+    stats = current()
+    if stats:
+        stats.record(service, call)
+
+def _begin():
+    with _lock:
+        _active.setdefault(_requestId(), []).append(RequestStats(request.endpoint or "unmatched"))
+
+def _status(response):
+    stats = current()
+    if stats:
+        stats.status = response.status_code
+    return response
+
+def _end(app):
+    requestId = _requestId()
+    with _lock:
+        stack = _active.get(requestId)
+        if not stack:
+            return
+        stats = stack.pop()
+        if not stack:
+            del _active[requestId]
+    elapsed = (time.time() - stats.start) * 1000.0
+    summary = stats.summary(elapsed)
+    logging.info("request_metrics " + json.dumps(summary, sort_keys=True))
+    for listener in _listeners:
+        listener(summary)
+
+    threshold = app.config.get('SLOW_REQUEST_MS')
+    if threshold is not None and elapsed > threshold:
+        logging.warning("Slow request: {} took {:.0f}ms, {} RPCs: {}".format(
+            stats.endpoint, elapsed, sum(stats.rpcs.values()),
+            ", ".join("{} {}".format(n, name) for name, n in stats.rpcs.most_common())))
+
+    minute = int(time.time() // 60)
+    with _lock:
+        if not _minutes or _minutes[-1][0] != minute:
+            _minutes.append((minute, {}))
+        endpoints = _minutes[-1][1]
+        endpoints.setdefault(stats.endpoint, EndpointStats()).add(stats, elapsed)
+
+def snapshot():
+    """ The window's totals by endpoint, merged across minutes """
+    oldest = int(time.time() // 60) - WINDOW_MINUTES
+    merged = {}
+    with _lock:
+        for minute, endpoints in _minutes:
+            if minute <= oldest:
+                continue
+            for endpoint, stats in endpoints.items():
+                merged.setdefault(endpoint, EndpointStats()).merge(stats)
+    return merged
+
+def addListener(listener):
+    """ Calls listener with the summary of every request that finishes,
+    the same dict that's logged """
+    _listeners.append(listener)
+
+def install(app):
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("request_metrics", _countRpc)
+
+    app.before_request(_begin)
+    app.after_request(_status)
+    app.teardown_request(lambda exc: _end(app))
@@ -0,0 +1,89 @@
+"""
+Measures how long a new SantaBot instance takes to serve its first page.
+
+    python startup_time.py --sdk ~/google-cloud-sdk/platform/google_appengine --runs 10
+
+Each run is a fresh Python process, like a new instance, on the App Engine
+SDK's in-memory stubs. It times importing main, the /_ah/warmup request,
+and the first and second home page after it. Half the runs skip the
+warmup, to show what the first user pays without one.
+"""
+
+import argparse, json, os, subprocess, sys, time
+
+from loadtest import setUpPaths
+
+def child(sdk, warm):
+    """ One new instance. Prints its timings, in ms, as JSON. """
+    timings = {}
+    setUpPaths(sdk)
+
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    tb.init_memcache_stub()
+    tb.init_user_stub()
+    tb.init_mail_stub()
+    tb.init_app_identity_stub()
+    tb.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    start = time.time()
+    import main
+    timings["import"] = (time.time() - start) * 1000.0
+
+    main.SantaPerson(key=main.SantaPerson.keyFor("100001"), userId="100001",
+        email="santa@example.com", name="Santa").put()
+    tb.setup_env(overwrite=True, USER_EMAIL="santa@example.com", USER_ID="100001", USER_IS_ADMIN="0")
+    client = main.app.test_client()
+
+    if warm:
+        start = time.time()
+        client.get("/_ah/warmup")
+        timings["warmup"] = (time.time() - start) * 1000.0
+
+    for name in ("first page", "second page"):
+        start = time.time()
+        client.get("/")
+        timings[name] = (time.time() - start) * 1000.0
+
+    print(json.dumps(timings))
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description="Time SantaBot's cold start")
+    parser.add_argument("--sdk", default=os.environ.get("APPENGINE_SDK"),
+        help="the App Engine Python SDK directory, or set APPENGINE_SDK")
+    parser.add_argument("--runs", type=int, default=5, help="new processes per mode")
+    parser.add_argument("--child", choices=["warm", "cold"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.sdk:
+        parser.error("need --sdk or APPENGINE_SDK")
+    if args.child:
+        return child(args.sdk, args.child == "warm")
+
+    columns = ["import", "warmup", "first page", "second page"]
+    print("{:<6} {:>10} {:>10} {:>12} {:>12}   (median ms of {} runs)".format("mode", *(columns + [args.runs])))
+    for mode in ("cold", "warm"):
+        runs = []
+        for run in range(args.runs):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                "--sdk", args.sdk, "--child", mode])
+            runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+
+        cells = []
+        for column in columns:
+            values = [r[column] for r in runs if column in r]
+            cells.append("{:.1f}".format(median(values)) if values else "-")
+        print("{:<6} {:>10} {:>10} {:>12} {:>12}".format(mode, *cells))
+
+if __name__ == "__main__":
+    main()